@@ -0,0 +1,340 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+#
+# Benchmarks of the hot paths of the charm, run against the test harness with
+# the Pebble calls that the testing Pebble client does not support mocked.
+#
+# Run from the project root with `./run_benchmarks`; see DEVELOPMENT.md.
+
+import argparse
+import io
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+
+from unittest.mock import patch
+
+import ops
+
+from charm import CloudNativeBuildpackCharm
+from ops.model import Container
+from ops.testing import Harness
+from template_globals import materialize
+
+SPRING_BOOT_METADATA_FIXTURE = "tests/fixtures/cnb-metadata/spring_boot.toml"
+
+# Regressions smaller than this, in seconds, are considered noise
+DEFAULT_NOISE_THRESHOLD = 0.0005
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_REPEAT = 5
+
+_BOM_ENTRY = """[[bom]]
+  name = "helper"
+  [bom.metadata]
+    layer = "helper"
+    names = ["ca-certificates-helper"]
+    version = "2.2.0"
+  [bom.buildpack]
+    id = "paketo-buildpacks/ca-certificates"
+    version = "2.2.0"
+
+"""
+
+
+class Scenario:
+    """Shape of the model and of the manifest a benchmark runs against"""
+
+    def __init__(self, name, relations=1, units=1, templates=2, template_size=64,
+                 metadata_size=0, aggregates=False):
+        self.name = name
+        self.relations = relations
+        self.units = units
+        self.templates = templates
+        self.template_size = template_size
+        self.metadata_size = metadata_size
+        self.aggregates = aggregates
+
+    def parameters(self):
+        return {
+            "relations": self.relations,
+            "units": self.units,
+            "templates": self.templates,
+            "template_size": self.template_size,
+            "metadata_size": self.metadata_size,
+            "aggregates": self.aggregates,
+        }
+
+
+SCENARIOS = [
+    Scenario("small"),
+    Scenario("many-relations", relations=20),
+    Scenario("many-units", units=200),
+    Scenario("many-relations-and-units", relations=10, units=50),
+    Scenario("many-templates", templates=100),
+    Scenario("many-templates-and-units", templates=100, units=100),
+    Scenario("many-templates-and-units-aggregated", templates=100, units=100, aggregates=True),
+    Scenario("large-templates", templates=20, template_size=64 * 1024),
+    Scenario("large-metadata", metadata_size=4 * 1024 * 1024),
+]
+
+
+def _relation_name(index):
+    return f"relation-{index}"
+
+
+def _charm_metadata(scenario):
+    requires = "".join(f"  {_relation_name(index)}:\n    interface: benchmark\n"
+                       for index in range(scenario.relations))
+
+    return f"""name: benchmark
+containers:
+  application:
+    resource: application-image
+requires:
+{requires}resources:
+  application-image:
+    type: oci-image
+"""
+
+
+def _charm_config(scenario):
+    """Manifest with half of the templates as environment variables and half
+       as files; each template reads the app data of one relation, and the
+       data of all the units of another one, either with a loop or from an
+       aggregate
+    """
+
+    environment = []
+    files = []
+    for index in range(scenario.templates):
+        app_relation = _relation_name(index % scenario.relations)
+        units_relation = _relation_name((index + 1) % scenario.relations)
+
+        if scenario.aggregates:
+            units_template = (f"{{{{relations.consumes['{units_relation}']"
+                              ".aggregates.addresses}}")
+        else:
+            units_template = (f"{{% for unit in relations.consumes['{units_relation}'].units %}}"
+                              "{{unit.address}},{% endfor %}")
+
+        template = f"{{{{relations.consumes['{app_relation}'].app.endpoint}}}};{units_template}"
+        padding = "x" * max(0, scenario.template_size - len(template))
+
+        if index % 2 == 0:
+            environment.append({"name": f"VARIABLE_{index}", "template": template + padding})
+        else:
+            files.append({"path": f"/benchmark/file-{index}", "template": template + padding})
+
+    aggregates = [{"name": "addresses", "relation": _relation_name(index), "field": "address"}
+                  for index in range(scenario.relations)] if scenario.aggregates else []
+
+    return {"environment": environment, "files": files, "aggregates": aggregates}
+
+
+def _cnb_metadata(scenario):
+    with open(SPRING_BOOT_METADATA_FIXTURE) as metadata_file:
+        metadata = metadata_file.read()
+
+    # The `bom` tables, which precede the `processes` ones, make up most of
+    # the metadata of real-world images
+    padding_entries = max(0, scenario.metadata_size - len(metadata)) // len(_BOM_ENTRY)
+
+    return _BOM_ENTRY * padding_entries + metadata
+
+
+def _setup_harness(scenario):
+    harness = Harness(CloudNativeBuildpackCharm, meta=_charm_metadata(scenario))
+    harness.begin()
+
+    with harness.hooks_disabled():
+        for relation_index in range(scenario.relations):
+            remote_app = f"remote-{relation_index}"
+            relation_id = harness.add_relation(_relation_name(relation_index), remote_app)
+            harness.update_relation_data(relation_id, remote_app, {
+                "endpoint": f"{remote_app}.example.com:1234"
+            })
+
+            for unit_index in range(scenario.units):
+                remote_unit = f"{remote_app}/{unit_index}"
+                harness.add_relation_unit(relation_id, remote_unit)
+                harness.update_relation_data(relation_id, remote_unit, {
+                    "address": f"10.0.{relation_index}.{unit_index}"
+                })
+
+    return harness
+
+
+def _measure(func, repeat, reset=None):
+    timings = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+    }
+
+
+def run_scenario(scenario, repeat=DEFAULT_REPEAT):
+    config = _charm_config(scenario)
+    metadata = _cnb_metadata(scenario)
+
+    with patch.object(CloudNativeBuildpackCharm, "_get_configs", new=lambda charm: config), \
+            patch.object(Container, "pull",
+                         new=lambda container, path, **kwargs: io.StringIO(metadata)), \
+            patch.object(Container, "push",
+                         new=lambda container, path, content, **kwargs: content.read()), \
+            patch.object(Container, "make_dir"):
+        harness = _setup_harness(scenario)
+
+        try:
+            charm = harness.charm
+            stored = charm._stored
+
+            def _forget_application_type():
+                stored.application_type = None
+                stored.cnb_metadata = {}
+
+            def _forget_reconcile():
+                stored.reconcile_fingerprint = None
+                stored.rendered_files = {}
+                stored.template_cache = {}
+
+            measurements = {
+                "determine_application_type": _measure(
+                    charm._determine_application_type, repeat,
+                    reset=_forget_application_type),
+                "calculate_template_globals": _measure(
+                    lambda: materialize(charm._calculate_template_globals()), repeat),
+                "ensure_application_updated_and_running": _measure(
+                    charm._ensure_application_updated_and_running, repeat,
+                    reset=_forget_reconcile),
+            }
+
+            # Work done by a reconcile that renders all templates
+            counters = materialize(stored.reconcile_profiles[-1]["counters"])
+
+            # The reconcile that follows one with the same inputs takes the fast path
+            measurements["ensure_application_updated_and_running_unchanged"] = _measure(
+                charm._ensure_application_updated_and_running, repeat)
+
+            return {
+                "scenario": scenario.name,
+                "parameters": scenario.parameters(),
+                "measurements": measurements,
+                "counters": counters,
+            }
+        finally:
+            harness.cleanup()
+
+
+def run_benchmarks(scenarios, repeat=DEFAULT_REPEAT):
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "ops": getattr(ops, "__version__", None),
+        },
+        "repeat": repeat,
+        "results": [run_scenario(scenario, repeat) for scenario in scenarios],
+    }
+
+
+def compare_with_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE,
+                          noise_threshold=DEFAULT_NOISE_THRESHOLD):
+    """Compare the median timings of `report` with those of `baseline`, and
+       return the comparison of each measurement found in both.
+
+       A measurement regressed if its median grew by more than `tolerance`,
+       relative to the baseline, and by more than `noise_threshold` seconds.
+    """
+
+    baseline_results = {result["scenario"]: result for result in baseline.get("results", [])}
+
+    comparisons = []
+    for result in report["results"]:
+        baseline_result = baseline_results.get(result["scenario"])
+        if baseline_result is None:
+            continue
+
+        for name, measurement in result["measurements"].items():
+            baseline_measurement = baseline_result["measurements"].get(name)
+            if baseline_measurement is None:
+                continue
+
+            current = measurement["median"]
+            previous = baseline_measurement["median"]
+            ratio = current / previous if previous else None
+            regressed = ratio is not None and ratio > 1 + tolerance \
+                and current - previous > noise_threshold
+
+            comparisons.append({
+                "scenario": result["scenario"],
+                "measurement": name,
+                "baseline": previous,
+                "current": current,
+                "ratio": ratio,
+                "regressed": regressed,
+            })
+
+    return comparisons
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the charm")
+    parser.add_argument("--scenario", action="append", dest="scenarios",
+                        choices=[scenario.name for scenario in SCENARIOS],
+                        help="scenario to run, can be repeated; all scenarios by default")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="how many times each measurement is repeated")
+    parser.add_argument("--output", help="file to write the JSON results to, instead "
+                        "of the standard output")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare "
+                        "with; exits with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative growth of the median timings considered a "
+                        "regression")
+    options = parser.parse_args(args)
+
+    # The charm logs a lot at debug level, which would skew the timings
+    logging.disable(logging.CRITICAL)
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not options.scenarios or scenario.name in options.scenarios]
+
+    report = run_benchmarks(scenarios, options.repeat)
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        report["comparison"] = compare_with_baseline(report, baseline, options.tolerance)
+        regressions = [comparison for comparison in report["comparison"]
+                       if comparison["regressed"]]
+
+    serialized_report = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(serialized_report)
+    else:
+        print(serialized_report)
+
+    for regression in regressions:
+        print(f"Regression in {regression['scenario']}/{regression['measurement']}: "
+              f"{regression['baseline']:.6f}s -> {regression['current']:.6f}s",
+              file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
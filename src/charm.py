@@ -5,40 +5,84 @@
 # Learn more at: https://juju.is/docs/sdk
 
 import functools
+import hashlib
 import logging
 import json
-import toml
-
-from enum import Enum
-from jinja2 import Environment
+import os
+import shlex
+import time
+import yaml
 
 from jinja2.exceptions import UndefinedError
 
 from os import path
 
+from cnb_metadata import CNB_METADATA_PATH, ApplicationType, detect_application_type, \
+    process_argv, read_metadata
+from container_limits import ContainerLimits, read_container_limits
+from health import check_http_health, check_tcp_health, wait_until_healthy
+from process_services import SERVICE_EXIT_POLICIES, WEB_PROCESS_TYPE, ProcessService, \
+    parse_process_replicas, plan_process_services
+from profiling import BYTES_PUSHED, FILES_PUSHED, TEMPLATES_RENDERED, ReconcileProfile, \
+    append_profile
+from rolling_restart import RESTART_GRANTED_KEY, RESTART_RELATION, RESTART_REQUESTED_KEY, \
+    grant_restart_locks, read_granted
+from runtime_tuning import NODE_CLUSTER_WORKERS, append_java_tool_options, apply_overrides, \
+    cluster_workers, jvm_tuning_environment, nodejs_tuning_environment
+from rendered_files import DEFAULT_PUSH_CONCURRENCY, StreamedContent, remove_stale_files, \
+    sync_rendered_files
+from startup_archive import MINIMUM_JVM_MAJOR_VERSION, jvm_major_version, \
+    remove_stale_startup_archives, startup_archive_exists, startup_archive_options, \
+    startup_archive_path
+from template_globals import LazyRelationData, materialize, relation_data_digest, select
+from templates import CharmTemplates, RenderBudget, RenderBudgetExceededException, \
+    create_template_environment, environment_template_name, file_template_name, template_sources
+
 from ops.charm import CharmBase
 from ops.charm import ActionEvent, ConfigChangedEvent, PebbleReadyEvent, \
     RelationBrokenEvent, StartEvent, UpgradeCharmEvent
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
-from ops.pebble import APIError
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError, \
+    WaitingStatus
+from ops.pebble import APIError, ConnectionError as PebbleConnectionError
 
 logger = logging.getLogger(__name__)
 
-CNB_METADATA_PATH = "/layers/config/metadata.toml"
 CNB_LIFECYCLE_WEB_PATH = "/cnb/process/web"
+CNB_LAUNCHER_PATH = "/cnb/lifecycle/launcher"
+
+# Script, shipped with the charm, running Node.js applications in cluster mode,
+# and where it is pushed in the application container
+NODE_JS_CLUSTER_SCRIPT = "nodejs_cluster.js"
+NODE_JS_CLUSTER_SCRIPT_PATH = "/var/lib/cnb-operator/nodejs/cluster.js"
+
+# Types of applications whose runtime is tuned to the container limits
+JVM_APPLICATION_TYPES = (ApplicationType.JVM.name, ApplicationType.SPRING_BOOT.name)
+TUNED_APPLICATION_TYPES = JVM_APPLICATION_TYPES + (ApplicationType.NODE_JS.name,)
+
+# How often, in seconds, the application is probed while waiting for it to
+# stop or to be ready
+SERVICE_POLL_INTERVAL = 0.5
+
+# Values of the `on-change` policy of files in the manifest
+FILE_POLICY_RESTART = "restart"
+FILE_POLICY_SIGNAL_PREFIX = "signal:"
+FILE_POLICY_NONE = "none"
+
+
+def _event_argument(args):
+    """Return the event among the arguments of a decorated event handler, or
+       `None` if it has been invoked without one
+    """
+
+    event = args[0] if len(args) > 0 else None
 
+    if isinstance(event, str):
+        # TODO Quirk of the test harness?
+        return None
 
-class ApplicationType(Enum):
-    NOT_CNB = -1
-    UNKNOWN = 0
-    JVM = 1
-    SPRING_BOOT = 2
-    # NODE_JS = 10
-    # PYTHON = 20
-    # RUBY = 30
-    # DOT_NET = 40
+    return event
 
 
 def _catch_block_status(func):
@@ -68,19 +112,41 @@ def _ensure_charm_state(func):
 
     @functools.wraps(func)
     def _decorator_func(self, *args, **kwargs):
-        event = None
-        if len(args) > 0:
-            event = args[0]
+        event = _event_argument(args)
 
         def _defer_event(event):
-            if event is not None and type(event) != str:
-                # TODO Quirk of the test harness?
-                event.defer()
+            # At most one event is kept deferred: it stands for all the events
+            # that could not be handled, as they would all lead to the same
+            # reconcile once the charm state allows it
+            self._stored.reconcile_needed = True
+
+            if event is None:
+                return
+
+            if self._stored.deferred_event not in (None, event.handle.path):
+                logger.debug("Event %s dropped, a reconcile is already pending "
+                             "with the deferred event %s",
+                             event.handle.path, self._stored.deferred_event)
+                return
+
+            self._stored.deferred_event = event.handle.path
+            event.defer()
+
+        if event is not None and event.handle.path == self._stored.deferred_event:
+            # Re-emission of the deferred event; it is deferred again below
+            # if the charm state still does not allow reconciling
+            self._stored.deferred_event = None
+
+            if not self._stored.reconcile_needed:
+                logger.debug("Deferred event %s dropped, the application has "
+                             "been reconciled since it was deferred",
+                             event.handle.path)
+                return
 
         # Check required relations are all there
         relations = self.model.relations
         missing_relations = [relation_name for relation_name
-                             in relations
+                             in self.meta.requires
                              if not relations or not relations[relation_name]]
 
         if missing_relations:
@@ -120,11 +186,55 @@ def _ensure_charm_state(func):
 
                 return
 
+        if self._stored.reconcile_needed and kwargs.get("affected_relations") is not None:
+            # The events dropped while the reconcile was pending may have been
+            # about any relation, so the templates of all of them are rendered
+            logger.debug("A reconcile is pending, rendering the templates of all "
+                         "relations")
+            kwargs["affected_relations"] = None
+
         return func(self, *args, **kwargs)
 
     return _decorator_func
 
 
+def _record_reconcile_profile(func):
+    """
+        This decorator records the profile of a reconcile, i.e., how long
+        each of its phases took, in the StoredState and in the debug logs.
+        It must wrap `_ensure_charm_state`, so that the detection of the
+        application type it may trigger is profiled too.
+    """
+
+    @functools.wraps(func)
+    def _decorator_func(self, *args, **kwargs):
+        event = _event_argument(args)
+        if event is not None:
+            event_name = event.handle.kind
+        else:
+            event_name = path.basename(os.environ.get("JUJU_DISPATCH_PATH", "")) or None
+
+        profile = self._profile()
+        if profile.event_name is None:
+            profile.event_name = event_name
+
+        try:
+            with profile.phase("total"):
+                return func(self, *args, **kwargs)
+        finally:
+            self._reconcile_profile = None
+
+            profile.outcome = f"{self.unit.status.name}: {self.unit.status.message}" \
+                if self.unit.status.message else self.unit.status.name
+
+            profile_data = profile.to_dict()
+            append_profile(self._stored.reconcile_profiles, profile_data)
+
+            logger.debug("Reconcile profile: %s", json.dumps(profile_data, sort_keys=True))
+
+    return _decorator_func
+
+
 # TODOs:
 #
 # * Look up how to open ports in the pod
@@ -164,19 +274,70 @@ class CloudNativeBuildpackCharm(CharmBase):
             self.framework.observe(self.on[relation_name].relation_broken,
                                    self._on_relation_broken)
 
+        if RESTART_RELATION in self.meta.peers:
+            self.framework.observe(self.on[RESTART_RELATION].relation_changed,
+                                   self._on_restart_relation_changed)
+            self.framework.observe(self.on[RESTART_RELATION].relation_departed,
+                                   self._on_restart_relation_changed)
+            self.framework.observe(self.on.leader_elected,
+                                   self._on_restart_relation_changed)
+
         self.framework.observe(self.on.evaluate_template_action,
                                self._on_evaluate_template_action)
+        self.framework.observe(self.on.evaluate_templates_action,
+                               self._on_evaluate_templates_action)
         self.framework.observe(self.on.dump_template_globals_action,
                                self._on_dump_template_globals_action)
+        self.framework.observe(self.on.reconcile_profile_action,
+                               self._on_reconcile_profile_action)
+
+        # Profile of the reconcile in progress, see `_record_reconcile_profile`
+        self._reconcile_profile = None
 
         self.unit.status = MaintenanceStatus(
             "Waiting for Pebble to initialize in the application container"
         )
 
         self._stored.set_default(application_type=None)
-        self._stored.set_default(current_environment={})
-        # Key: path in application container; Value: hash of file content
+        # Application type and processes detected from the CNB metadata, and
+        # the digest of the application image they have been detected in
+        self._stored.set_default(cnb_metadata={})
+        # Digest of the environment the application has been started with; the
+        # values are not stored, as they may contain secrets
+        self._stored.set_default(current_environment_digest=None)
+        # Key: path in application container; Value: digest of file content
         self._stored.set_default(rendered_files={})
+        # Type, index and whether it is enabled of the services of the non-web
+        # processes in the Pebble layer
+        self._stored.set_default(process_services=[])
+        # Same as `rendered_files`, for the files shipped with the charm that
+        # the runtime tuning needs, like the Node.js cluster script
+        self._stored.set_default(runtime_files={})
+        # Digest of the template sources and of the last rendered environment,
+        # used to avoid rendering templates not affected by a relation change
+        self._stored.set_default(template_cache={})
+        # Digest of the inputs of the last successful reconcile
+        self._stored.set_default(reconcile_fingerprint=None)
+        # Key: relation name; Value: digest of the relation data
+        self._stored.set_default(relation_digests={})
+        # Whether events could not be handled because relations were missing or
+        # Pebble was not ready, and the handle of the one event kept deferred
+        self._stored.set_default(reconcile_needed=False)
+        self._stored.set_default(deferred_event=None)
+        # Digest of the environment of a debounced restart, and since when the
+        # environment has not changed
+        self._stored.set_default(pending_restart_digest=None)
+        self._stored.set_default(pending_restart_since=None)
+        # Whether files changed that require the application to be restarted
+        self._stored.set_default(restart_required=False)
+        # Profiles of the most recent reconciles, oldest first
+        self._stored.set_default(reconcile_profiles=[])
+        # Whether the application has been (re)started, and has not been ready
+        # yet since then
+        self._stored.set_default(awaiting_readiness=False)
+        # Since when the application, restarted while holding the rolling
+        # restart lock, is waiting to become healthy to release it
+        self._stored.set_default(restart_lock_held_since=None)
 
     def _on_evaluate_template_action(self, event: ActionEvent):
         try:
@@ -186,7 +347,7 @@ class CloudNativeBuildpackCharm(CharmBase):
 
             template_globals = self._calculate_template_globals()
 
-            template_environment = Environment()
+            template_environment = create_template_environment()
 
             rendered_template = template_environment \
                 .from_string(template, template_globals).render()
@@ -199,9 +360,71 @@ class CloudNativeBuildpackCharm(CharmBase):
             logger.exception("Action 'evaluate-template' failed")
             event.fail(f"Action 'evaluate-template' failed: {str(e)}")
 
-    def _on_dump_template_globals_action(self, event: ActionEvent):
+    def _on_evaluate_templates_action(self, event: ActionEvent):
+        """Evaluate many templates at once: the template globals are calculated,
+           and the relation data bags fetched, once for all of them
+        """
+
         try:
+            sources = dict(event.params.get("templates") or {})
+
+            manifest = event.params.get("manifest")
+            if manifest:
+                sources.update(template_sources(yaml.safe_load(manifest) or {}))
+
+            if event.params.get("declared", False):
+                sources.update(template_sources(self._get_configs()))
+
+            if not sources:
+                raise ValueError("no templates to evaluate, set either the 'templates', "
+                                 "'manifest' or 'declared' parameter")
+
+            logger.debug("Action 'evaluate-templates', templates: %s", ", ".join(sources))
+
+            start = time.perf_counter()
             template_globals = self._calculate_template_globals()
+            globals_time = time.perf_counter() - start
+
+            template_environment = create_template_environment()
+            budget = self._get_render_budget()
+
+            results = []
+            for name, source in sources.items():
+                result = {"name": name}
+
+                start = time.perf_counter()
+                try:
+                    result["rendered-template"] = budget.render(
+                        name, template_environment.from_string(source), template_globals)
+                except RenderBudgetExceededException as e:
+                    result["error"] = e.message
+                except Exception as e:
+                    result["error"] = str(e)
+                result["render-time"] = round(time.perf_counter() - start, 6)
+
+                results.append(result)
+
+            event.set_results({
+                "templates": json.dumps(results),
+                "failed": len([result for result in results if "error" in result]),
+                "globals-time": round(globals_time, 6)
+            })
+        except Exception as e:
+            logger.exception("Action 'evaluate-templates' failed")
+            event.fail(f"Action 'evaluate-templates' failed: {str(e)}")
+
+    def _on_dump_template_globals_action(self, event: ActionEvent):
+        try:
+            selector = event.params.get("selector")
+
+            template_globals = select(self._calculate_template_globals(),
+                                      selector=selector,
+                                      offset=event.params.get("offset", 0),
+                                      limit=event.params.get("limit"),
+                                      keys_only=event.params.get("keys-only", False))
+
+            if template_globals is None:
+                raise ValueError(f"selector '{selector}' matches no template globals")
 
             event.set_results({
                 "template-globals": template_globals
@@ -210,24 +433,107 @@ class CloudNativeBuildpackCharm(CharmBase):
             logger.exception("Action 'dump-template-globals' failed")
             event.fail(f"Action 'dump-template-globals' failed: {str(e)}")
 
+    def _on_reconcile_profile_action(self, event: ActionEvent):
+        try:
+            profiles = list(self._stored.reconcile_profiles)
+
+            limit = event.params.get("limit")
+            if limit:
+                profiles = profiles[-limit:]
+
+            event.set_results({
+                "profiles": json.dumps([materialize(profile) for profile in profiles],
+                                       sort_keys=True)
+            })
+        except Exception as e:
+            logger.exception("Action 'reconcile-profile' failed")
+            event.fail(f"Action 'reconcile-profile' failed: {str(e)}")
+
     def _on_start(self, event: StartEvent):
-        self._ensure_application_updated_and_running()
+        self._ensure_application_updated_and_running(event)
 
     @_catch_block_status
     def _on_upgrade_charm(self, event: UpgradeCharmEvent = None):
         # The logic to identify CNB images could have changed
         self._stored.application_type = None
+        self._stored.cnb_metadata = {}
+        # And so could how the application is configured and started
+        self._stored.reconcile_fingerprint = None
+
+        # Previous revisions of the charm stored the environment values
+        previous_environment = getattr(self._stored, "current_environment", None)
+        if previous_environment:
+            self._stored.current_environment_digest = _environment_digest(
+                dict(previous_environment))
+            self._stored.current_environment = {}
+        self._stored.template_cache = {}
 
         self._on_config_changed(None)
         self._on_application_pebble_ready(None)
 
     @_catch_block_status
     def _on_update_status(self, event=None):
-        self._ensure_application_updated_and_running()
+        if self._stored.reconcile_fingerprint is None or self._stored.reconcile_needed or \
+                self._stored.pending_restart_since is not None or \
+                self._is_waiting_for_restart_lock():
+            # The application has never been reconciled successfully, events
+            # have been dropped while waiting for relations or Pebble, or a
+            # debounced restart or one waiting for the rolling restart lock
+            # is pending
+            self._ensure_application_updated_and_running()
+            return
+
+        self._check_application_health()
+
+    def _check_application_health(self):
+        """Check that the application is running and, if a health check URL or
+           port is configured, healthy; the application is reconciled again only
+           if it is not running.
+        """
+
+        application_container = self.unit.get_container("application")
+
+        if not self._is_application_running(application_container):
+            logger.info("The application is not running, reconciling it")
+            self._ensure_application_updated_and_running()
+            return
+
+        failure = self._probe_application_health()
+        if failure is not None:
+            self._release_restart_lock_on_timeout()
+
+            if self._stored.awaiting_readiness:
+                raise WaitingStatusException(f"Application not ready: {failure}")
+
+            raise WaitingStatusException(f"Application health check failed: {failure}")
+
+        self._stored.awaiting_readiness = False
+        self._release_restart_lock()
+
+        self.unit.status = ActiveStatus()
+
+    def _probe_application_health(self):
+        """Probe the health check URL or, if none is configured, the health
+           check port; returns the failure, or `None` if the application is
+           healthy or neither is configured
+        """
+
+        timeout = self.config.get("health-check-timeout")
+
+        health_check_url = self.config.get("health-check-url")
+        if health_check_url:
+            return check_http_health(health_check_url, timeout)
+
+        health_check_port = self.config.get("health-check-port")
+        if health_check_port:
+            # The containers of the pod share the network namespace
+            return check_tcp_health("localhost", health_check_port, timeout)
+
+        return None
 
     @_catch_block_status
     def _on_config_changed(self, event: ConfigChangedEvent = None):
-        self._ensure_application_updated_and_running()
+        self._ensure_application_updated_and_running(event)
 
     @_catch_block_status
     def _on_application_pebble_ready(self, event: PebbleReadyEvent = None):
@@ -242,12 +548,19 @@ class CloudNativeBuildpackCharm(CharmBase):
                 "Application not packaged with Cloud Native Buildpacks"
             )
 
-        self._ensure_application_updated_and_running()
+        self._ensure_application_updated_and_running(event)
 
     def _determine_application_type(self):
+        with self._profile().phase("metadata-detection"):
+            self._detect_application_type()
+
+    def _detect_application_type(self):
         """ Check if it is a Buildpack application (by looking for the
             `${LAYERS_DIR}/config/metadata.toml` file) and,
-            if found, which type of app it is
+            if found, which type of app it is. The result is cached
+            together with the digest of the application image resource,
+            so that the metadata is pulled and parsed only when the
+            image changes.
         """
 
         previous_type = self._stored.application_type
@@ -256,15 +569,30 @@ class CloudNativeBuildpackCharm(CharmBase):
             logger.debug("Checking if the application type changed from %s",
                          previous_type)
 
-        application_container = self.unit.get_container("application")
+        image_digest = self._application_image_digest()
+        cached_metadata = self._stored.cnb_metadata
+        if image_digest is not None and cached_metadata.get("image") == image_digest:
+            logger.debug("Application image unchanged, using the cached CNB metadata")
+            self._stored.application_type = cached_metadata["application_type"]
+            return
+
+        application_container = self._application_container()
         # TODO Support lookup of the ${LAYERS_DIR} value when we can
         #      execute commands via Pebble
 
-        parsed_metadata = None
+        processes = None
+        helpers = []
+        jvm_version = None
+        # Only definitive results, i.e., the metadata or its confirmed absence,
+        # are cached, so that transient failures are retried by the next hook
+        cacheable = True
         try:
             metadata_file = application_container.pull(CNB_METADATA_PATH)
 
-            parsed_metadata = toml.loads(metadata_file.read())
+            metadata = read_metadata(metadata_file)
+            processes = metadata["processes"]
+            helpers = metadata["helpers"]
+            jvm_version = metadata["jvm_version"]
         except APIError as e:
             if "No such file or directory" in str(e):
                 logger.debug("'%s' file not found in the application container",
@@ -274,181 +602,1048 @@ class CloudNativeBuildpackCharm(CharmBase):
                              "application container for the "
                              f"'{CNB_METADATA_PATH}' file; is Pebble ready?")
                 return
+        except PebbleConnectionError:
+            logger.debug("Cannot connect to Pebble to look in the application "
+                         "container for the '%s' file; is Pebble ready?",
+                         CNB_METADATA_PATH)
+            return
         except Exception:
             logger.exception("An error occurred while looking in the application "
                              "container for the '%s' file", CNB_METADATA_PATH)
+            cacheable = False
 
-        if parsed_metadata is None:
+        if processes is None:
             self._stored.application_type = ApplicationType.NOT_CNB.name
-            return
+        else:
+            # OK, it looks like a CNB image
+            self._stored.application_type = detect_application_type(processes).name
 
-        # OK, it looks like a CNB image
-        self._stored.application_type = ApplicationType.UNKNOWN.name
-
-        # TODO Look into multi-process CNBs
-        if parsed_metadata["processes"]:
-            for process in parsed_metadata["processes"]:
-                if process["command"] == "java":
-                    self._stored.application_type = ApplicationType.JVM.name
-                    if process["args"] and \
-                       "org.springframework.boot.loader.JarLauncher" in process["args"]:
+        if not cacheable:
+            self._stored.cnb_metadata = {}
+            return
 
-                        self._stored.application_type = ApplicationType.SPRING_BOOT.name
+        self._stored.cnb_metadata = {
+            "image": image_digest,
+            "application_type": self._stored.application_type,
+            "processes": processes or [],
+            "helpers": helpers,
+            "jvm_version": jvm_version
+        }
 
         if previous_type != self._stored.application_type:
             logger.info("Detected a %s application", self._stored.application_type)
 
+    def _application_image_digest(self):
+        """Digest of the `application-image` resource, which identifies the
+           image; `None` if the resource cannot be fetched
+        """
+
+        try:
+            resource_path = self.model.resources.fetch("application-image")
+
+            with open(resource_path, "rb") as resource_file:
+                return hashlib.sha256(resource_file.read()).hexdigest()
+        except (ModelError, NameError, OSError) as e:
+            logger.debug("Cannot fetch the 'application-image' resource: %s", e)
+            return None
+
     def _on_relation_upserted(self, event=None):
-        self._ensure_application_updated_and_running()
+        affected_relations = None
+        if event is not None:
+            affected_relations = [event.relation.name]
+
+        self._ensure_application_updated_and_running(event,
+                                                     affected_relations=affected_relations)
 
     def _on_relation_broken(self, event: RelationBrokenEvent = None):
-        self._ensure_application_updated_and_running()
+        self._ensure_application_updated_and_running(event)
 
+    @_record_reconcile_profile
     @_ensure_charm_state
     @_catch_block_status
-    def _ensure_application_updated_and_running(self):
+    def _ensure_application_updated_and_running(self, event=None, affected_relations=None):
         """This is the most central part of the charm. This method must be invoked
            by pretty much every callback for every event that will require to either
-           start or restart the application
+           start or restart the application. The `event` is deferred if the charm
+           state does not allow reconciling yet, see `_ensure_charm_state`.
+
+           When `affected_relations` is specified, only the templates that read data
+           of those relations are rendered again.
         """
 
-        application_container = self.unit.get_container("application")
+        profile = self._profile()
+        application_container = self._application_container()
 
-        template_globals = self._calculate_template_globals()
+        with profile.phase("template-globals"):
+            template_globals = self._calculate_template_globals()
 
-        template_environment = Environment()
-        new_environment = {}
+        with profile.phase("templates-loading"):
+            config = self._get_configs()
+            templates = self._get_templates(config)
 
-        config = self._get_configs()
+        with profile.phase("fingerprint"):
+            fingerprint = self._calculate_reconcile_fingerprint(template_globals, templates,
+                                                                affected_relations)
+            reconciled = self._is_reconciled(application_container, fingerprint)
 
-        if "environment" in config:
-            for environment_variable in config["environment"]:
-                env_name = environment_variable["name"]
-                env_template = environment_variable["template"]
+        if reconciled:
+            logger.debug("No changes since the last reconcile, and the application "
+                         "is running")
+            self._stored.reconcile_needed = False
 
-                try:
-                    value = template_environment.from_string(env_template,
-                                                             template_globals).render()
+            if self._stored.awaiting_readiness:
+                self._check_application_health()
+                return
 
-                    new_environment[env_name] = value
-                except UndefinedError:
-                    logger.exception(f"Cannot render environment variable '{env_name}'")
-                    raise BlockedStatusException("Cannot render environment variables")
+            self.unit.status = ActiveStatus()
+            return
 
-        if "files" in config:
-            previous_files = self._stored.rendered_files
+        self._forget_files_of_new_container(application_container)
+
+        with profile.phase("render"):
+            new_environment, rendered_files, unaffected_files = self._render_templates(
+                application_container, config, templates, template_globals,
+                affected_relations)
+
+        with profile.phase("runtime-tuning"):
+            limits = self._read_container_limits(application_container)
+            workers = self._get_cluster_workers(limits)
+
+            new_environment = self._build_application_environment(
+                config, limits, workers, new_environment)
+            command = self._build_application_command(application_container, workers)
+            process_services = self._plan_process_services()
+
+        changed_files = []
+        if rendered_files or unaffected_files:
+            with profile.phase("push"):
+                report = sync_rendered_files(
+                    application_container,
+                    rendered_files,
+                    self._stored.rendered_files,
+                    verify=self.config.get("verify-rendered-files", False),
+                    concurrency=self.config.get("file-push-concurrency",
+                                                DEFAULT_PUSH_CONCURRENCY))
+            report.skipped.extend(unaffected_files)
+
+            profile.count(FILES_PUSHED, len(report.pushed))
+            profile.count(BYTES_PUSHED, report.pushed_bytes)
+
+            logger.debug("Rendered files: %s", report)
+
+            if report.failed:
+                path = report.failed[0]
+                raise CannotPushFileToApplicationContainerException(
+                    path, f"Cannot push file '{path}' to the application container")
+
+            changed_files = report.pushed
+
+        with profile.phase("garbage-collection"):
+            removed_files = self._remove_undeclared_files(application_container, config)
+            changed_files = changed_files + removed_files
+
+        def _add_lifecycle_layer(environment):
+            # The other processes run without startup archive, which would be
+            # dumped by more than one JVM
+            layer = self._build_lifecycle_layer(environment, command, process_services,
+                                                new_environment)
+
+            # Layers passed as dictionaries are stripped of the fields that
+            # `ops.pebble.Service` does not know, like the exit policies
+            application_container.add_layer("cnb_lifecycle", yaml.safe_dump(layer),
+                                            combine=True)
+
+        with profile.phase("layer"):
+            layer_environment = self._add_startup_archive_options(application_container,
+                                                                  new_environment)
+            _add_lifecycle_layer(layer_environment)
+
+            self._stored.process_services = [
+                [service.process_type, service.index, service.enabled]
+                for service in process_services.values()
+            ]
 
-            for file in config["files"]:
-                path = file["path"]
-                content_template = file["template"]
+        logger.debug("Layer 'cnb_lifecycle' updated")
 
-                content = None
-                try:
-                    content = template_environment.from_string(content_template,
-                                                               template_globals).render()
-                except UndefinedError:
-                    logger.exception(f"Cannot render file '{path}'")
-                    raise BlockedStatusException("Cannot render files")
+        self.unit.status = MaintenanceStatus("Evaluating an application (re)start")
 
-                content_hash = hash(content)
-                if path in previous_files:
-                    if content_hash is previous_files[path]:
-                        continue
+        with profile.phase("service"):
+            log_start = True
+            restart_processes = _environment_digest(new_environment) != \
+                self._stored.current_environment_digest
+            if application_container.get_service("application").is_running():
+                signals = self._apply_file_change_policies(config, changed_files)
+
+                restart_required = self._stored.restart_required or \
+                    _environment_digest(new_environment) != \
+                    self._stored.current_environment_digest
+                if signals and not restart_required:
+                    signalled = self._signal_application(application_container, signals)
+                    restart_required = not signalled
+
+                if not restart_required:
+                    logger.debug(
+                        "No changes in configuration detected, the application "
+                        "will not be restarted"
+                    )
+
+                    self._clear_pending_restart()
+
+                    if self._is_waiting_for_restart_lock():
+                        # The changes have been reverted in the meantime
+                        self._withdraw_restart_lock_request()
+                elif self._is_restart_debounced(new_environment):
+                    logger.info(
+                        "Configuration changes detected, the application will be "
+                        "restarted once they settle"
+                    )
+
+                    self.unit.status = ActiveStatus(
+                        "Restart pending to apply configuration changes")
+                    return
+                elif not self._acquire_restart_lock():
+                    logger.info(
+                        "Configuration changes detected, the application will be "
+                        "restarted once other units are done restarting"
+                    )
+
+                    self.unit.status = ActiveStatus(
+                        "Restart pending, waiting for other units to restart")
+                    return
+                else:
+                    logger.info(
+                        "Restarting the application to apply configuration "
+                        "changes"
+                    )
+                    log_start = False
+
+                    self.unit.status = MaintenanceStatus("Restarting the application")
+
+                    self._stop_services(application_container, "application")
+                    restart_processes = True
+
+                    # The JVM dumps the startup archive when it exits
+                    restart_environment = self._add_startup_archive_options(
+                        application_container, new_environment)
+                    if restart_environment != layer_environment:
+                        layer_environment = restart_environment
+                        _add_lifecycle_layer(layer_environment)
+
+            if not application_container.get_service("application").is_running():
+                if log_start is True:
+                    self.unit.status = MaintenanceStatus("Starting the application")
+                    logger.info("Starting the application")
+
+                logger.debug("Application environment: %s",
+                             layer_environment)
+
+                application_container.start("application")
+                logger.debug("Application started")
+
+                self._stored.awaiting_readiness = True
+
+                self._clear_pending_restart()
+                self._stored.restart_required = False
+
+                if self._is_restart_lock_requested():
+                    self._stored.restart_lock_held_since = time.time()
+
+                self._stored.current_environment_digest = _environment_digest(new_environment)
+                logger.debug("Application environment updated to: %s", new_environment)
+
+            self._update_process_services(application_container, process_services,
+                                          restart_processes)
+
+        readiness_failure = None
+        if self._stored.awaiting_readiness:
+            with profile.phase("readiness"):
+                readiness_failure = self._wait_until_ready()
+
+        if self._stored.restart_lock_held_since is not None:
+            if readiness_failure is None:
+                self._release_restart_lock()
+            else:
+                logger.info("The application is not ready yet, the rolling restart "
+                            "lock is kept until it is")
 
-                self._stored.rendered_files[path] = content_hash
+        self._stored.reconcile_fingerprint = fingerprint
+        self._stored.reconcile_needed = False
 
-                try:
-                    application_container.push(path, content)
-                except Exception:
-                    message = f"Cannot push file '{path}' to the application container"
-                    logger.exception(message)
-                    raise CannotPushFileToApplicationContainerException(path, message)
+        if readiness_failure is not None:
+            raise WaitingStatusException(f"Application not ready: {readiness_failure}")
+
+        self.unit.status = ActiveStatus()
+
+    def _wait_until_ready(self):
+        """Wait for the (re)started application to be healthy, for at most
+           `readiness-timeout` seconds, so that the unit is set in Active status,
+           and lets other units restart, only once the application can serve;
+           returns the last failure of the health check, or `None` if the
+           application is ready
+        """
+
+        self.unit.status = MaintenanceStatus("Waiting for the application to be ready")
+
+        failure = wait_until_healthy(self._probe_application_health,
+                                     self.config.get("readiness-timeout", 60),
+                                     interval=SERVICE_POLL_INTERVAL)
+        if failure is None:
+            self._stored.awaiting_readiness = False
+            logger.info("The application is ready")
+        else:
+            logger.info("The application is not ready yet: %s", failure)
+
+        return failure
+
+    def _stop_services(self, application_container, *service_names):
+        """Stop the services gracefully: they are sent SIGTERM first, and are
+           given `termination-grace-period` seconds to complete the requests in
+           flight and exit, before Pebble stops them, killing them if they do
+           not exit within its own timeout
+        """
+
+        grace_period = self.config.get("termination-grace-period", 0)
+        if grace_period > 0:
+            try:
+                application_container.send_signal("SIGTERM", *service_names)
+            except Exception:
+                logger.exception("Cannot send SIGTERM to %s, stopping without grace "
+                                 "period", ", ".join(service_names))
+            else:
+                deadline = time.monotonic() + grace_period
+
+                running = list(service_names)
+                while running and time.monotonic() < deadline:
+                    time.sleep(SERVICE_POLL_INTERVAL)
+
+                    services = application_container.get_services(*running)
+                    running = [name for name in running
+                               if name in services and services[name].is_running()]
+
+                if running:
+                    logger.info("Services still running after the termination grace "
+                                "period: %s", ", ".join(running))
+
+                service_names = running
+
+        if service_names:
+            application_container.stop(*service_names)
+
+    def _profile(self):
+        """Profile of the reconcile in progress, created on first access"""
+
+        if self._reconcile_profile is None:
+            self._reconcile_profile = ReconcileProfile()
+
+        return self._reconcile_profile
+
+    def _application_container(self):
+        """The application container, with the Pebble calls made through it
+           counted in the profile of the reconcile in progress
+        """
+
+        return self._profile().track_pebble_calls(self.unit.get_container("application"))
+
+    def _remove_undeclared_files(self, application_container, config):
+        """Delete from the application container the files rendered by previous
+           reconciles that are no longer declared in the config, e.g., after an
+           upgrade of the charm, and forget about them; returns their paths
+        """
+
+        declared_paths = {file["path"] for file in config.get("files") or []}
+
+        report = remove_stale_files(application_container, self._stored.rendered_files,
+                                    declared_paths)
+
+        if report.removed or report.failed:
+            logger.debug("Files no longer declared: %s", report)
+
+        if report.failed:
+            path = report.failed[0]
+            raise CannotDeleteFileFromApplicationContainerException(
+                path, f"Cannot delete file '{path}' from the application container")
+
+        return report.removed
+
+    def _apply_file_change_policies(self, config, changed_files):
+        """Apply the `on-change` policy of the files changed while the application
+           is running: `restart` files require a restart, which is persisted until
+           the application is restarted, `none` files are ignored and for
+           `signal:<SIGNAL>` files the signals to send to the application are
+           returned
+        """
+
+        policies = {file["path"]: file.get("on-change", FILE_POLICY_RESTART)
+                    for file in config.get("files") or []}
+
+        signals = []
+        for file_path in changed_files:
+            policy = policies.get(file_path, FILE_POLICY_RESTART)
+
+            if policy == FILE_POLICY_RESTART:
+                logger.debug("File '%s' changed, the application must be restarted",
+                             file_path)
+                self._stored.restart_required = True
+            elif policy.startswith(FILE_POLICY_SIGNAL_PREFIX):
+                signal = policy[len(FILE_POLICY_SIGNAL_PREFIX):]
+                if signal not in signals:
+                    signals.append(signal)
+
+        return signals
+
+    def _signal_application(self, application_container, signals):
+        """Send the signals to the application; if any cannot be sent, the
+           application must be restarted instead
+        """
+
+        for signal in signals:
+            logger.info("Sending %s to the application to reload changed files", signal)
+
+            try:
+                application_container.send_signal(signal, "application",
+                                                  *self._enabled_process_services())
+            except Exception:
+                logger.exception("Cannot send %s to the application, it will be "
+                                 "restarted instead", signal)
+                self._stored.restart_required = True
+                return False
+
+        return True
+
+    def _is_restart_debounced(self, new_environment):
+        """Restarts are debounced by the `restart-debounce-window` configuration:
+           the application is restarted only once its environment and files have
+           not changed for that many seconds, so that bursts of relation changes
+           lead to one restart. Pending restarts are applied by the first hook
+           after the window.
+        """
 
-        application_container.add_layer("cnb_lifecycle", {
+        debounce_window = self.config.get("restart-debounce-window", 0)
+        if not debounce_window:
+            return False
+
+        serialized_configuration = json.dumps({
+            "environment": new_environment,
+            "files": dict(self._stored.rendered_files)
+        }, sort_keys=True)
+        configuration_digest = hashlib.sha256(
+            serialized_configuration.encode("utf-8")).hexdigest()
+
+        now = time.time()
+        if self._stored.pending_restart_digest != configuration_digest:
+            self._stored.pending_restart_digest = configuration_digest
+            self._stored.pending_restart_since = now
+
+        return now - self._stored.pending_restart_since < debounce_window
+
+    def _on_restart_relation_changed(self, event):
+        if self.unit.is_leader():
+            self._grant_restart_locks()
+
+        if self._is_waiting_for_restart_lock() and self._holds_restart_lock():
+            logger.info("Rolling restart lock granted")
+            self._ensure_application_updated_and_running(event)
+
+    def _restart_relation(self):
+        if RESTART_RELATION not in self.meta.peers:
+            return None
+
+        return self.model.get_relation(RESTART_RELATION)
+
+    def _acquire_restart_lock(self):
+        """Request the rolling restart lock, which the leader grants to at most
+           `max-concurrent-restarts` units at once; returns whether this unit
+           holds it. Units hold the lock until they are healthy again after
+           restarting, so that the next units restart only then.
+        """
+
+        max_concurrent_restarts = self.config.get("max-concurrent-restarts", 1)
+
+        relation = self._restart_relation()
+        if relation is None or not relation.units or not max_concurrent_restarts:
+            # No other units to coordinate with
+            return True
+
+        unit_data = relation.data[self.unit]
+        if RESTART_REQUESTED_KEY not in unit_data:
+            logger.debug("Requesting the rolling restart lock")
+            unit_data[RESTART_REQUESTED_KEY] = str(time.time())
+
+        if self.unit.is_leader():
+            self._grant_restart_locks()
+
+        return self._holds_restart_lock()
+
+    def _grant_restart_locks(self):
+        relation = self._restart_relation()
+        if relation is None:
+            return
+
+        requests = {}
+        for unit in [self.unit] + sorted(relation.units, key=lambda unit: unit.name):
+            requested_at = relation.data[unit].get(RESTART_REQUESTED_KEY)
+            if requested_at:
+                requests[unit.name] = requested_at
+
+        app_data = relation.data[self.app]
+        granted = read_granted(app_data)
+        holders = grant_restart_locks(requests, granted,
+                                      self.config.get("max-concurrent-restarts", 1))
+
+        if holders != granted:
+            logger.debug("Rolling restart lock granted to: %s", ", ".join(holders) or "none")
+            app_data[RESTART_GRANTED_KEY] = json.dumps(holders)
+
+    def _is_restart_lock_requested(self):
+        relation = self._restart_relation()
+
+        return relation is not None and RESTART_REQUESTED_KEY in relation.data[self.unit]
+
+    def _is_waiting_for_restart_lock(self):
+        return self._is_restart_lock_requested() and \
+            self._stored.restart_lock_held_since is None
+
+    def _holds_restart_lock(self):
+        relation = self._restart_relation()
+        if relation is None:
+            return False
+
+        return self.unit.name in read_granted(relation.data[self.app])
+
+    def _release_restart_lock(self):
+        """Withdraw the request of the rolling restart lock once the application
+           is healthy after the restart, so that the leader grants it to the
+           next units
+        """
+
+        if self._stored.restart_lock_held_since is None:
+            return
+
+        self._stored.restart_lock_held_since = None
+
+        logger.info("Releasing the rolling restart lock")
+        self._withdraw_restart_lock_request()
+
+    def _withdraw_restart_lock_request(self):
+        relation = self._restart_relation()
+        if relation is None:
+            return
+
+        relation.data[self.unit].pop(RESTART_REQUESTED_KEY, None)
+
+        if self.unit.is_leader():
+            self._grant_restart_locks()
+
+    def _release_restart_lock_on_timeout(self):
+        """Release the rolling restart lock if the application did not become
+           healthy within `restart-lock-timeout` seconds, so that one unhealthy
+           unit does not stop the other ones from restarting
+        """
+
+        held_since = self._stored.restart_lock_held_since
+        if held_since is None:
+            return
+
+        if time.time() - held_since >= self.config.get("restart-lock-timeout", 600):
+            logger.warning("The application did not become healthy after restarting "
+                           "within the rolling restart lock timeout")
+            self._release_restart_lock()
+
+    def _clear_pending_restart(self):
+        self._stored.pending_restart_digest = None
+        self._stored.pending_restart_since = None
+
+    def _build_lifecycle_layer(self, environment, command=CNB_LIFECYCLE_WEB_PATH,
+                               process_services=None, process_environment=None):
+        """Layer with the `application` service, running the web process, and
+           the services of the other processes, which are run with
+           `process_environment`, if specified, or `environment`
+        """
+
+        # Pebble restarts the services that exit, unless they are stopped
+        # gracefully, see `_stop_services`
+        exit_policies = SERVICE_EXIT_POLICIES \
+            if self.config.get("termination-grace-period", 0) > 0 else {}
+
+        services = {
+            "application": {
+                "override": "replace",
+                "summary": "Bootstraps the Cloud Native Buildpack lifecycle",
+                "command": command,
+                "environment": environment,
+                "startup": "enabled",
+                **exit_policies,
+            }
+        }
+
+        if process_environment is None:
+            process_environment = environment
+
+        for name, service in (process_services or {}).items():
+            services[name] = service.to_layer_service(process_environment, exit_policies)
+
+        return {
             "summary": "cnb lifecycle layer",
             "description": "Pebble service layer to start the application",
-            "services": {
-                "application": {
-                    "override": "replace",
-                    "summary": "Bootstraps the Cloud Native Buildpack lifecycle",
-                    "command": CNB_LIFECYCLE_WEB_PATH,
-                    "environment": new_environment,
-                    "startup": "enabled",
-                }
-            },
-        }, combine=True)
+            "services": services,
+        }
 
-        logger.debug("Layer 'cnb_lifecycle' updated")
+    def _plan_process_services(self):
+        """Services of the non-web processes of the CNB image, with the replicas
+           of the `process-replicas` configuration
+        """
 
-        self.unit.status = MaintenanceStatus("Evaluating an application (re)start")
+        try:
+            replicas = parse_process_replicas(self.config.get("process-replicas", ""))
+        except ValueError as e:
+            raise BlockedStatusException(f"Invalid 'process-replicas' configuration: {e}")
 
-        log_start = True
-        if application_container.get_service("application").is_running():
-            # TODO Check that files did not change
-            if new_environment == self._stored.current_environment:
-                logger.debug(
-                    "No changes in configuration detected, the application "
-                    "will not be restarted"
-                )
+        process_types = [process["type"]
+                         for process in self._stored.cnb_metadata.get("processes") or []]
+
+        if WEB_PROCESS_TYPE in replicas:
+            raise BlockedStatusException("The 'web' process cannot have replicas")
+
+        unknown_types = sorted(set(replicas) - set(process_types))
+        if unknown_types:
+            raise BlockedStatusException(
+                f"Unknown process types in 'process-replicas': {', '.join(unknown_types)}")
+
+        previous_services = [(process_type, index)
+                             for process_type, index, _ in self._stored.process_services]
+
+        return plan_process_services(process_types, replicas, previous_services)
+
+    def _enabled_process_services(self):
+        return [ProcessService(process_type, index).name
+                for process_type, index, enabled in self._stored.process_services
+                if enabled]
+
+    def _update_process_services(self, application_container, process_services, restart):
+        """Start the enabled services of the non-web processes that are not
+           running, or all of them if `restart`, and stop the disabled ones
+        """
+
+        if not process_services:
+            return
+
+        services = application_container.get_services(*process_services)
+        running = [name for name, service in services.items() if service.is_running()]
+
+        stopping = [name for name in running
+                    if restart or not process_services[name].enabled]
+        if stopping:
+            logger.info("Stopping the processes: %s", ", ".join(stopping))
+            self._stop_services(application_container, *stopping)
+
+        starting = [name for name, service in process_services.items()
+                    if service.enabled and (name in stopping or name not in running)]
+        if starting:
+            logger.info("Starting the processes: %s", ", ".join(starting))
+            application_container.start(*starting)
+
+    def _calculate_reconcile_fingerprint(self, template_globals, templates,
+                                         affected_relations=None):
+        """Digest of all the inputs of a reconcile: relation data, charm configuration,
+           application type, templates and the Pebble layer they are rendered into.
+
+           Unless `affected_relations` is `None`, the digests of the data of the other
+           relations are taken from the StoredState, so that their data bags need not
+           be fetched.
+        """
+
+        stored_digests = self._stored.relation_digests \
+            if affected_relations is not None else {}
+
+        relation_digests = {}
+        for relation_name, relation_data in template_globals["relations"]["consumes"].items():
+            if relation_name in stored_digests and relation_name not in affected_relations:
+                relation_digests[relation_name] = stored_digests[relation_name]
             else:
-                logger.info(
-                    "Restarting the application to apply configuration "
-                    "changes"
-                )
-                log_start = False
+                relation_digests[relation_name] = relation_data_digest(relation_data)
 
-                self.unit.status = MaintenanceStatus("Restarting the application")
+        self._stored.relation_digests = relation_digests
 
-                application_container.stop("application")
+        fingerprint_inputs = {
+            "application_type": self._stored.application_type,
+            "config": dict(self.config),
+            "layer": self._build_lifecycle_layer({}),
+            "relations": relation_digests,
+            "templates": templates.sources_digest,
+        }
+
+        serialized_inputs = json.dumps(fingerprint_inputs, sort_keys=True)
 
-        if not application_container.get_service("application").is_running():
-            if log_start is True:
-                self.unit.status = MaintenanceStatus("Starting the application")
-                logger.info("Starting the application")
+        return hashlib.sha256(serialized_inputs.encode("utf-8")).hexdigest()
 
-            logger.debug("Application environment: %s",
-                         new_environment)
+    def _is_reconciled(self, application_container, fingerprint):
+        """The application is reconciled if nothing changed since the last
+           successful reconcile, and it is still running
+        """
 
-            application_container.start("application")
-            logger.debug("Application started")
+        if fingerprint != self._stored.reconcile_fingerprint:
+            return False
 
-            self._stored.current_environment = new_environment
-            logger.debug("Application environment updated to: %s", new_environment)
+        # Files must be checked against the application container
+        if self.config.get("verify-rendered-files", False):
+            return False
 
-        self.unit.status = ActiveStatus()
+        if self._stored.pending_restart_since is not None:
+            return False
+
+        return self._is_application_running(application_container)
+
+    def _is_application_running(self, application_container):
+        # The services are not found if the application container has been restarted
+        names = ["application"] + self._enabled_process_services()
+        services = application_container.get_services(*names)
+
+        return all(name in services and services[name].is_running() for name in names)
+
+    def _render_templates(self, application_container, config, templates, template_globals,
+                          affected_relations=None):
+        """Render the environment variables and files declared in the config.
+
+           Returns the environment, the list of `(path, StreamedContent)` of the rendered files
+           and the list of paths of the files that did not need rendering. Unless
+           `affected_relations` is `None`, templates that do not read data of the
+           affected relations are not rendered: environment values are taken from the
+           Pebble plan of the application container, if they match the digest in the
+           template cache, and files are left untouched, as their content cannot have
+           changed since they have been last pushed.
+        """
+
+        template_cache = dict(self._stored.template_cache)
+        sources_digest = templates.sources_digest
+
+        # The cache is valid only once all the templates have been rendered
+        # successfully: otherwise, the next reconcile would reuse the values
+        # rendered before the failure, and skip the templates that failed
+        self._stored.template_cache = {}
+
+        use_cache = affected_relations is not None and \
+            template_cache.get("sources") == sources_digest
+        cached_environment = {}
+        if use_cache:
+            # The planned environment also contains the runtime tuning
+            declared_names = {environment_variable["name"]
+                              for environment_variable in config.get("environment") or []}
+            cached_environment = {
+                name: value
+                for name, value in self._get_planned_environment(application_container).items()
+                if name in declared_names
+            }
+
+            if _environment_digest(cached_environment) != template_cache.get("environment"):
+                logger.debug("The environment in the Pebble plan does not match the "
+                             "template cache; rendering all templates")
+                use_cache = False
+                cached_environment = {}
+        # Files missing from the application container must be rendered to be pushed
+        verify_files = self.config.get("verify-rendered-files", False)
+
+        budget = self._get_render_budget()
+
+        def _needs_rendering(name, cached):
+            return not use_cache or not cached or \
+                templates.is_affected_by(name, affected_relations)
+
+        new_environment = {}
+        cached_values = 0
+        for environment_variable in config.get("environment") or []:
+            env_name = environment_variable["name"]
+
+            if not _needs_rendering(environment_template_name(env_name),
+                                    env_name in cached_environment):
+                new_environment[env_name] = cached_environment[env_name]
+                cached_values += 1
+                continue
+
+            try:
+                self._profile().count(TEMPLATES_RENDERED)
+                new_environment[env_name] = budget.render(
+                    environment_template_name(env_name),
+                    templates.environment_template(env_name),
+                    template_globals)
+            except UndefinedError:
+                logger.exception(f"Cannot render environment variable '{env_name}'")
+                raise BlockedStatusException("Cannot render environment variables")
+            except RenderBudgetExceededException as e:
+                logger.error(e.message)
+                raise BlockedStatusException(e.message)
+
+        try:
+            budget.check_environment(new_environment)
+        except RenderBudgetExceededException as e:
+            logger.error(e.message)
+            raise BlockedStatusException(e.message)
+
+        rendered_files = []
+        unaffected_files = []
+        for file in config.get("files") or []:
+            path = file["path"]
+
+            if not _needs_rendering(file_template_name(path),
+                                    path in self._stored.rendered_files and not verify_files):
+                unaffected_files.append(path)
+                continue
+
+            # Files are rendered in chunks twice: once here to calculate their
+            # digest, and once more, if they changed, while being pushed
+            content = StreamedContent(functools.partial(
+                budget.generate, file_template_name(path), templates.file_template(path),
+                template_globals))
+
+            try:
+                self._profile().count(TEMPLATES_RENDERED)
+                content.digest()
+            except UndefinedError:
+                logger.exception(f"Cannot render file '{path}'")
+                raise BlockedStatusException("Cannot render files")
+            except RenderBudgetExceededException as e:
+                logger.error(e.message)
+                raise BlockedStatusException(e.message)
+
+            rendered_files.append((path, content))
+
+        if affected_relations is not None:
+            logger.debug("Rendered %d of %d templates affected by changes in the "
+                         "relations: %s",
+                         len(new_environment) - cached_values + len(rendered_files),
+                         len(new_environment) + len(rendered_files) + len(unaffected_files),
+                         ", ".join(affected_relations))
+
+        self._stored.template_cache = {
+            "sources": sources_digest,
+            "environment": _environment_digest(new_environment)
+        }
+
+        return new_environment, rendered_files, unaffected_files
+
+    def _read_container_limits(self, application_container):
+        """Limits of the application container, read only if they are used to
+           tune the runtime of the application
+        """
+
+        if self._stored.application_type not in TUNED_APPLICATION_TYPES:
+            return ContainerLimits()
+
+        if not self.config.get("runtime-tuning", True) and \
+                not self.config.get("cluster-mode", False):
+            return ContainerLimits()
+
+        limits = read_container_limits(application_container)
+        logger.debug("Limits of the application container: %s", limits)
+
+        return limits
+
+    def _get_cluster_workers(self, limits):
+        """Amount of workers to run Node.js applications with, if the
+           `cluster-mode` configuration is enabled and the web process can be run
+           in a cluster; `None` otherwise
+        """
+
+        if not self.config.get("cluster-mode", False) or \
+                self._stored.application_type != ApplicationType.NODE_JS.name:
+            return None
+
+        if self._get_node_web_process_argv() is None:
+            logger.warning("Cluster mode requires the web process of the application "
+                           "to run a script with 'node'; running without cluster")
+            return None
+
+        workers = cluster_workers(limits)
+        if workers is None:
+            logger.warning("Cluster mode requires a CPU limit on the application "
+                           "container; running without cluster")
+
+        return workers
+
+    def _get_node_web_process_argv(self):
+        for process in self._stored.cnb_metadata.get("processes") or []:
+            if process["type"] == "web":
+                argv = process_argv(process)
+                if argv and path.basename(argv[0]) == "node" and len(argv) > 1:
+                    return argv
+
+                return None
+
+        return None
+
+    def _build_application_environment(self, config, limits, workers, rendered_environment):
+        """Add to the rendered environment the variables that tune the runtime
+           of the application to the limits of the application container, with
+           the overrides declared in the manifest; rendered variables take
+           precedence over both
+        """
+
+        tuning_environment = {}
+        if self.config.get("runtime-tuning", True):
+            application_type = self._stored.application_type
+
+            if application_type in JVM_APPLICATION_TYPES:
+                tuning_environment = jvm_tuning_environment(
+                    limits, self._stored.cnb_metadata.get("helpers") or [])
+            elif application_type == ApplicationType.NODE_JS.name:
+                tuning_environment = nodejs_tuning_environment(limits, workers or 1)
+
+            tuning_environment = apply_overrides(
+                tuning_environment, (config.get("tuning") or {}).get("environment"))
+
+        environment = dict(tuning_environment)
+        environment.update(rendered_environment)
+
+        if workers is not None:
+            # Changing the amount of workers restarts the application
+            environment[NODE_CLUSTER_WORKERS] = str(workers)
+
+        return environment
+
+    def _build_application_command(self, application_container, workers):
+        """Command of the application service: the web process of the CNB
+           lifecycle or, in cluster mode, the script of the web process run by
+           the cluster script, which is pushed to the application container
+        """
+
+        if workers is None:
+            return CNB_LIFECYCLE_WEB_PATH
+
+        with open(f"{path.dirname(path.realpath(__file__))}/{NODE_JS_CLUSTER_SCRIPT}") \
+                as script_file:
+            script = script_file.read()
+
+        report = sync_rendered_files(application_container,
+                                     [(NODE_JS_CLUSTER_SCRIPT_PATH, script)],
+                                     self._stored.runtime_files, verify=True)
+
+        self._profile().count(FILES_PUSHED, len(report.pushed))
+        self._profile().count(BYTES_PUSHED, report.pushed_bytes)
+
+        if report.failed:
+            raise CannotPushFileToApplicationContainerException(
+                NODE_JS_CLUSTER_SCRIPT_PATH,
+                f"Cannot push file '{NODE_JS_CLUSTER_SCRIPT_PATH}' to the application "
+                "container")
+
+        # The launcher runs the command with the environment of the CNB layers,
+        # in which `node` is on the PATH, from the application directory
+        argv = [CNB_LAUNCHER_PATH, "--", "node", NODE_JS_CLUSTER_SCRIPT_PATH] + \
+            self._get_node_web_process_argv()[1:]
+
+        return " ".join(shlex.quote(arg) for arg in argv)
+
+    def _add_startup_archive_options(self, application_container, environment):
+        """Add to `JAVA_TOOL_OPTIONS` the options to start the JVM with the class
+           data sharing archive of the application image, if enabled by the
+           `startup-acceleration` configuration: the archive is dumped when the
+           JVM first exits, and used by the following starts.
+
+           The options are not part of the environment compared to decide on
+           restarts, so that the application is not restarted only to use the
+           archive.
+        """
+
+        if not self.config.get("startup-acceleration", False):
+            return environment
+
+        if self._stored.application_type not in JVM_APPLICATION_TYPES:
+            return environment
+
+        cnb_metadata = materialize(self._stored.cnb_metadata)
+
+        jvm_version = cnb_metadata.get("jvm_version")
+        major_version = jvm_major_version(jvm_version)
+        if major_version is None or major_version < MINIMUM_JVM_MAJOR_VERSION:
+            logger.warning("Startup acceleration requires a JVM %d or newer, but the "
+                           "application image ships %s", MINIMUM_JVM_MAJOR_VERSION,
+                           f"JVM {jvm_version}" if jvm_version else "an unknown JVM")
+            return environment
+
+        archive_path = startup_archive_path(cnb_metadata)
+        archive_exists = startup_archive_exists(application_container, archive_path)
+
+        if not archive_exists:
+            removed_archives = remove_stale_startup_archives(application_container,
+                                                             archive_path)
+            if removed_archives:
+                logger.debug("Removed the startup archives of previous application "
+                             "images: %s", ", ".join(removed_archives))
+
+            try:
+                application_container.make_dir(path.dirname(archive_path),
+                                               make_parents=True)
+            except APIError:
+                logger.exception("Cannot create the directory of the startup archive")
+                return environment
+
+        logger.debug("Starting the application %s the startup archive '%s'",
+                     "with" if archive_exists else "dumping", archive_path)
+
+        return append_java_tool_options(environment,
+                                        startup_archive_options(archive_path, archive_exists))
+
+    def _forget_files_of_new_container(self, application_container):
+        """Forget the digests of the files pushed to the application container
+           if it has been replaced, e.g., after a crash or the rescheduling of
+           the pod, which is detected by the `application` service missing
+           from its plan: the files are lost with the filesystem of the
+           container, and must be pushed again
+        """
+
+        if "application" in application_container.get_plan().services:
+            return
+
+        if self._stored.rendered_files or self._stored.runtime_files:
+            logger.info("The application container has no Pebble plan, the files "
+                        "pushed to it will be pushed again")
+
+        self._stored.rendered_files = {}
+        self._stored.runtime_files = {}
+
+    def _get_planned_environment(self, application_container):
+        """Environment of the application in the Pebble plan, i.e., the one
+           rendered by the last reconcile that updated the layer
+        """
+
+        services = application_container.get_plan().services
+        if "application" not in services:
+            return {}
+
+        return dict(services["application"].environment or {})
 
     def _get_configs(self):
         with open(f"{path.dirname(path.realpath(__file__))}/config.json") as config_json:
             return json.load(config_json)
 
+    def _get_templates(self, config):
+        return CharmTemplates(config, path.dirname(path.realpath(__file__)),
+                              relation_names=self.meta.requires)
+
+    def _get_render_budget(self):
+        return RenderBudget(max_render_time=self.config.get("template-render-timeout"),
+                            max_output_size=self.config.get("template-max-output-size"),
+                            max_environment_size=self.config.get("environment-max-size"))
+
     def _calculate_template_globals(self):
-        relations_data = {}
-        for relation_name, relations in self.model.relations.items():
-            relation_data = {
-                "app": {}
-            }
+        """Calculate the globals available to templates; relation data bags are
+           fetched only when first accessed, and the aggregates declared in the
+           manifest calculated once per hook, see `LazyRelationData`
+        """
 
-            relations_data[relation_name] = relation_data
+        aggregates = {}
+        for aggregate in self._get_configs().get("aggregates") or []:
+            aggregates.setdefault(aggregate["relation"], []).append(aggregate)
 
+        relations_data = {}
+        for relation_name in self.meta.requires:
+            relations = self.model.relations[relation_name]
             if len(relations) < 1:
                 raise WaitingStatusException(
                     f"No remote unit is available for the {relation_name}"
                     " relation, cannot lookup application data")
-            else:
-                first_relation = relations[0]
-
-                relation_data["app"] = first_relation.data[first_relation.app] or {}
 
-                other_units = []
-                for relation in relations:
-                    for unit in relation.units:
-                        if unit is not self.unit:
-                            other_units.append({
-                                field: relation.data[unit].get(field) for field in
-                                relation.data[unit].keys()
-                            })
-
-                relation_data["units"] = other_units
+            relations_data[relation_name] = LazyRelationData(
+                relations, self.unit, aggregates=aggregates.get(relation_name))
 
         return {
             "relations": {
@@ -457,6 +1652,12 @@ class CloudNativeBuildpackCharm(CharmBase):
         }
 
 
+def _environment_digest(environment):
+    serialized_environment = json.dumps(environment, sort_keys=True)
+
+    return hashlib.sha256(serialized_environment.encode("utf-8")).hexdigest()
+
+
 class CannotPushFileToApplicationContainerException(Exception):
 
     def __init__(self, path, message):
@@ -0,0 +1,163 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import logging
+import posixpath
+import re
+import shlex
+import toml
+
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+CNB_METADATA_PATH = "/layers/config/metadata.toml"
+
+SPRING_BOOT_LAUNCHER = "org.springframework.boot.loader.JarLauncher"
+
+# Executables the processes of Node.js applications are started with, e.g.,
+# `node server.js` by the Paketo Node.js buildpacks, or `npm start`
+NODE_JS_COMMANDS = ("node", "npm", "yarn")
+
+# Helper shipped by the Paketo JVM buildpacks, which sizes the memory regions
+# of the JVM from the container memory limit when the application starts
+MEMORY_CALCULATOR_HELPER = "memory-calculator"
+
+# Matches table headers like `[[processes]]` or `[bom.metadata]`, capturing
+# the name of the top-level table
+_TABLE_HEADER = re.compile(r"^\s*\[\[?\s*([A-Za-z0-9_-]+)([^\]]*)\]\]?\s*(#.*)?$")
+
+# Matches the `layer`, `version` and `names = [...]` lines of the `metadata`
+# tables of the `bom` entries; the entries of the `helper` layer list the
+# helpers executed by the launcher before the processes, and those of the `jre`
+# and `jdk` layers the version of the JVM
+_BOM_METADATA_STRING = re.compile(r'^\s*(layer|version)\s*=\s*"([^"]*)"\s*$')
+_BOM_METADATA_NAMES = re.compile(r'^\s*names\s*=\s*\[(.*)\]\s*$')
+_QUOTED_STRING = re.compile(r'"([^"]*)"')
+
+_HELPER_LAYER = "helper"
+_JVM_LAYERS = ("jre", "jdk")
+
+
+class ApplicationType(Enum):
+    NOT_CNB = -1
+    UNKNOWN = 0
+    JVM = 1
+    SPRING_BOOT = 2
+    NODE_JS = 10
+    # PYTHON = 20
+    # RUBY = 30
+    # DOT_NET = 40
+
+
+def read_metadata(metadata_file):
+    """Read the `processes` of a CNB `metadata.toml` file, and the names of the
+       helpers and the version of the JVM in its `bom`, line by line and without
+       parsing the other tables, like the `bom` one, which make up most of the
+       file. Since the lifecycle writes the tables in alphabetical order, reading
+       stops at the first table after the `processes` ones.
+
+       Returns a compact summary of the processes, with only the keys the
+       charm uses, the sorted names of the helpers and the version of the JVM,
+       `None` if the image ships none.
+    """
+
+    process_lines = []
+    bom_entries = []
+    current_table = None
+    in_bom_metadata = False
+    for line in metadata_file:
+        header = _TABLE_HEADER.match(line)
+        if header:
+            if current_table == "processes" and header.group(1) != "processes":
+                break
+
+            current_table = header.group(1)
+            in_bom_metadata = current_table == "bom" and header.group(2).strip() == ".metadata"
+
+            if line.strip().startswith("[[bom]]"):
+                bom_entries.append({"names": []})
+
+        if current_table in (None, "processes"):
+            process_lines.append(line if line.endswith("\n") else f"{line}\n")
+        elif in_bom_metadata and bom_entries:
+            string_value = _BOM_METADATA_STRING.match(line)
+            if string_value:
+                bom_entries[-1][string_value.group(1)] = string_value.group(2)
+                continue
+
+            names = _BOM_METADATA_NAMES.match(line)
+            if names:
+                bom_entries[-1]["names"] = _QUOTED_STRING.findall(names.group(1))
+
+    processes = toml.loads("".join(process_lines)).get("processes") or []
+
+    helpers = set()
+    jvm_version = None
+    for entry in bom_entries:
+        if entry.get("layer") == _HELPER_LAYER:
+            helpers.update(entry["names"])
+        elif entry.get("layer") in _JVM_LAYERS and jvm_version is None:
+            jvm_version = entry.get("version")
+
+    return {
+        "processes": [{
+            "type": process.get("type"),
+            "command": process.get("command"),
+            "args": process.get("args") or [],
+            "direct": process.get("direct", False),
+        } for process in processes],
+        "helpers": sorted(helpers),
+        "jvm_version": jvm_version
+    }
+
+
+def read_processes(metadata_file):
+    """Read the `processes` of a CNB `metadata.toml` file, see `read_metadata`"""
+
+    return read_metadata(metadata_file)["processes"]
+
+
+def process_argv(process):
+    """Arguments of the command line of a process: the command of processes
+       that are not `direct` is a shell command line, which is split in the
+       same way as the shell would, if it has no shell syntax beyond quoting;
+       `None` if it cannot be split
+    """
+
+    if process.get("direct"):
+        return [process["command"]] + list(process.get("args") or [])
+
+    try:
+        argv = shlex.split(process["command"] or "")
+    except ValueError:
+        return None
+
+    if any(token in ("&&", "||", "|", ";", "&") or "$" in token or "`" in token
+           for token in argv):
+        return None
+
+    return argv + list(process.get("args") or [])
+
+
+def _command_name(process):
+    argv = process_argv(process)
+
+    return posixpath.basename(argv[0]) if argv else None
+
+
+def detect_application_type(processes):
+    """Detect the type of application from the processes of a CNB image"""
+
+    application_type = ApplicationType.UNKNOWN
+
+    for process in processes:
+        if process["command"] == "java":
+            application_type = ApplicationType.JVM
+            if SPRING_BOOT_LAUNCHER in process["args"]:
+                return ApplicationType.SPRING_BOOT
+        elif application_type == ApplicationType.UNKNOWN and \
+                _command_name(process) in NODE_JS_COMMANDS:
+            application_type = ApplicationType.NODE_JS
+
+    return application_type
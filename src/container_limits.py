@@ -0,0 +1,101 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import logging
+
+from ops.pebble import APIError
+
+logger = logging.getLogger(__name__)
+
+# The cgroup files are pulled from the application container, which sees
+# its own cgroup as the root one
+CGROUP_V2_MEMORY_MAX_PATH = "/sys/fs/cgroup/memory.max"
+CGROUP_V2_CPU_MAX_PATH = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_MEMORY_LIMIT_PATH = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+CGROUP_V1_CPU_QUOTA_PATH = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD_PATH = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+# cgroup v1 reports no memory limit as a value close to the maximum 64-bit integer
+_UNLIMITED_MEMORY = 1 << 60
+
+
+class ContainerLimits:
+    """Memory limit, in bytes, and CPU limit, in (possibly fractional) cores,
+       of a container; either is `None` if the container has no such limit,
+       or if it cannot be determined
+    """
+
+    def __init__(self, memory=None, cpus=None):
+        self.memory = memory
+        self.cpus = cpus
+
+    def __eq__(self, other):
+        return isinstance(other, ContainerLimits) and \
+            (self.memory, self.cpus) == (other.memory, other.cpus)
+
+    def __repr__(self):
+        return f"ContainerLimits(memory={self.memory}, cpus={self.cpus})"
+
+
+def parse_memory_limit(value):
+    """Parse the content of `memory.max` (cgroup v2) or
+       `memory.limit_in_bytes` (cgroup v1)
+    """
+
+    if value is None or value == "max":
+        return None
+
+    memory = int(value)
+
+    return memory if 0 < memory < _UNLIMITED_MEMORY else None
+
+
+def parse_cpu_limit(quota, period):
+    """Parse the CFS quota and period, in microseconds, of cgroup v1 or, split,
+       of the `cpu.max` file of cgroup v2
+    """
+
+    if quota is None or period is None or quota in ("max", "-1"):
+        return None
+
+    quota, period = int(quota), int(period)
+    if quota <= 0 or period <= 0:
+        return None
+
+    return quota / period
+
+
+def _read(container, path):
+    try:
+        cgroup_file = container.pull(path)
+    except APIError as e:
+        logger.debug("Cannot read '%s' in the application container: %s", path, e)
+        return None
+
+    try:
+        return cgroup_file.read().strip()
+    finally:
+        cgroup_file.close()
+
+
+def read_container_limits(container):
+    """Read the memory and CPU limits of the container from its cgroup files,
+       trying cgroup v2 first
+    """
+
+    try:
+        memory_max = _read(container, CGROUP_V2_MEMORY_MAX_PATH)
+        if memory_max is not None:
+            memory = parse_memory_limit(memory_max)
+
+            cpu_max = (_read(container, CGROUP_V2_CPU_MAX_PATH) or "max").split()
+            cpus = parse_cpu_limit(cpu_max[0], cpu_max[1] if len(cpu_max) > 1 else None)
+        else:
+            memory = parse_memory_limit(_read(container, CGROUP_V1_MEMORY_LIMIT_PATH))
+            cpus = parse_cpu_limit(_read(container, CGROUP_V1_CPU_QUOTA_PATH),
+                                   _read(container, CGROUP_V1_CPU_PERIOD_PATH))
+    except ValueError as e:
+        logger.debug("Cannot parse the cgroup files of the application container: %s", e)
+        return ContainerLimits()
+
+    return ContainerLimits(memory=memory, cpus=cpus)
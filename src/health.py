@@ -0,0 +1,72 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import logging
+import socket
+import time
+
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+
+def check_http_health(url, timeout):
+    """Probe the health of the application with an HTTP GET request, like the
+       `/actuator/health` endpoint of Spring Boot applications, which replies
+       with a 2xx status code when the application is healthy.
+
+       Returns `None` if the application is healthy, or the reason why it is not.
+    """
+
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except (URLError, OSError) as e:
+        reason = getattr(e, "reason", e)
+        logger.debug("Health check '%s' failed: %s", url, reason)
+        return str(reason)
+
+    if 200 <= status < 300:
+        return None
+
+    logger.debug("Health check '%s' failed with status code %d", url, status)
+    return f"status code {status}"
+
+
+def check_tcp_health(host, port, timeout):
+    """Probe that the application accepts connections on a TCP port, for
+       applications without an HTTP health endpoint.
+
+       Returns `None` if the application is healthy, or the reason why it is not.
+    """
+
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return None
+    except OSError as e:
+        reason = e.strerror or str(e)
+        logger.debug("Health check of port %d failed: %s", port, reason)
+        return f"port {port}: {reason}"
+
+
+def wait_until_healthy(check, timeout, interval=1.0):
+    """Probe the application with `check`, a callable returning `None` when the
+       application is healthy or the reason why it is not, until it is healthy
+       or `timeout` seconds have elapsed.
+
+       Returns `None` if the application became healthy, or the last reason why
+       it is not.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        failure = check()
+
+        remaining = deadline - time.monotonic()
+        if failure is None or remaining <= 0:
+            return failure
+
+        time.sleep(min(interval, remaining))
@@ -0,0 +1,83 @@
+// Copyright 2021 Ubuntu
+// See LICENSE file for licensing details.
+//
+// Runs the Node.js application whose script, preceded by its Node.js options
+// and followed by its arguments, is passed as arguments, in a cluster of
+// NODE_CLUSTER_WORKERS workers that share the ports the application listens
+// on. Workers that exit are forked again, and the signals that stop the
+// cluster are forwarded to the workers, as are those that ask the application
+// to reload its configuration, see the `on-change` policy of files.
+//
+// Pushed to the application container by the charm, see the `cluster-mode`
+// configuration option.
+
+"use strict";
+
+const cluster = require("cluster");
+
+const workers = parseInt(process.env.NODE_CLUSTER_WORKERS, 10) || 1;
+
+const argv = process.argv.slice(2);
+const scriptIndex = argv.findIndex((arg) => !arg.startsWith("-"));
+if (scriptIndex < 0) {
+  console.error("No script to run in the cluster");
+  process.exit(2);
+}
+
+const settings = {
+  execArgv: argv.slice(0, scriptIndex),
+  exec: argv[scriptIndex],
+  args: argv.slice(scriptIndex + 1),
+};
+(cluster.setupPrimary || cluster.setupMaster)(settings);
+
+let stopping = false;
+const workerIndexes = new Map();
+
+function fork(index) {
+  const worker = cluster.fork({ NODE_CLUSTER_WORKER_INDEX: String(index) });
+  workerIndexes.set(worker.id, index);
+}
+
+cluster.on("exit", (worker, code, signal) => {
+  const index = workerIndexes.get(worker.id);
+  workerIndexes.delete(worker.id);
+
+  if (stopping) {
+    if (workerIndexes.size === 0) {
+      process.exit(0);
+    }
+    return;
+  }
+
+  console.error(`Worker ${index} exited (${signal || code}), forking it again`);
+  fork(index);
+});
+
+function forward(signal) {
+  for (const worker of Object.values(cluster.workers)) {
+    worker.process.kill(signal);
+  }
+}
+
+for (const signal of ["SIGTERM", "SIGINT"]) {
+  process.on(signal, () => {
+    stopping = true;
+
+    forward(signal);
+
+    if (workerIndexes.size === 0) {
+      process.exit(0);
+    }
+  });
+}
+
+// Workers that do not handle these signals exit, and are forked again with
+// the new configuration
+for (const signal of ["SIGHUP", "SIGUSR2"]) {
+  process.on(signal, () => forward(signal));
+}
+
+for (let index = 0; index < workers; index++) {
+  fork(index);
+}
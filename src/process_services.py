@@ -0,0 +1,99 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import re
+
+# The web process runs as the `application` service
+WEB_PROCESS_TYPE = "web"
+
+CNB_PROCESS_PATH_PREFIX = "/cnb/process/"
+
+# Environment variables telling the replicas of a process apart
+PROCESS_TYPE_VARIABLE = "PROCESS_TYPE"
+PROCESS_INDEX_VARIABLE = "PROCESS_INDEX"
+
+# Exit policies of the services of applications stopped gracefully: Pebble
+# would otherwise restart them while they are being stopped, after being sent
+# SIGTERM; the charm restarts them on `update-status` instead
+SERVICE_EXIT_POLICIES = {
+    "on-success": "ignore",
+    "on-failure": "ignore",
+}
+
+_REPLICAS_ENTRY = re.compile(r"^\s*([A-Za-z0-9_.-]+)\s*=\s*(\d+)\s*$")
+
+
+class ProcessService:
+    """Pebble service running one replica of a non-web process of a CNB
+       image; services of replicas no longer wanted are kept in the plan,
+       but disabled, since services cannot be removed from a layer
+    """
+
+    def __init__(self, process_type, index, enabled=True):
+        self.process_type = process_type
+        self.index = index
+        self.enabled = enabled
+
+    @property
+    def name(self):
+        return f"{self.process_type}-{self.index}"
+
+    def to_layer_service(self, environment, exit_policies=None):
+        service_environment = dict(environment)
+        service_environment[PROCESS_TYPE_VARIABLE] = self.process_type
+        service_environment[PROCESS_INDEX_VARIABLE] = str(self.index)
+
+        return {
+            "override": "replace",
+            "summary": f"Runs the '{self.process_type}' process of the Cloud Native "
+                       "Buildpack lifecycle",
+            "command": f"{CNB_PROCESS_PATH_PREFIX}{self.process_type}",
+            "environment": service_environment,
+            "startup": "enabled" if self.enabled else "disabled",
+            **(exit_policies or {}),
+        }
+
+
+def parse_process_replicas(value):
+    """Parse replicas of processes formatted as `type=count[,type=count...]`,
+       e.g., `worker=2,scheduler=1`; raises `ValueError` if malformed
+    """
+
+    replicas = {}
+    for entry in (value or "").split(","):
+        if not entry.strip():
+            continue
+
+        match = _REPLICAS_ENTRY.match(entry)
+        if not match:
+            raise ValueError(f"'{entry.strip()}' is not formatted as 'type=count'")
+
+        replicas[match.group(1)] = int(match.group(2))
+
+    return replicas
+
+
+def plan_process_services(process_types, replicas, previous_services=()):
+    """Services of the non-web `process_types`: the first `replicas[type]` of
+       each type are enabled, and those among `previous_services`, a list of
+       `(process_type, index)` tuples, beyond them are disabled; returns a
+       mapping of service name to `ProcessService`, sorted by type and index
+    """
+
+    services = []
+    for process_type in process_types:
+        if process_type == WEB_PROCESS_TYPE:
+            continue
+
+        for index in range(replicas.get(process_type, 0)):
+            services.append(ProcessService(process_type, index))
+
+    enabled_services = {service.name for service in services}
+    for process_type, index in previous_services:
+        service = ProcessService(process_type, index, enabled=False)
+        if service.name not in enabled_services:
+            services.append(service)
+
+    services.sort(key=lambda service: (service.process_type, service.index))
+
+    return {service.name: service for service in services}
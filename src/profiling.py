@@ -0,0 +1,96 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import logging
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# How many reconcile profiles are kept in the StoredState
+RECONCILE_PROFILES_LIMIT = 10
+
+# Counters of a reconcile profile
+TEMPLATES_RENDERED = "templates-rendered"
+FILES_PUSHED = "files-pushed"
+BYTES_PUSHED = "bytes-pushed"
+PEBBLE_CALLS = "pebble-calls"
+
+
+class _PebbleCallsCounter:
+    """Proxy of a `Container` that counts the calls to its methods, all of
+       which are backed by requests to Pebble
+    """
+
+    def __init__(self, container, profile):
+        self._container = container
+        self._profile = profile
+
+    def __getattr__(self, name):
+        attribute = getattr(self._container, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def _counted_call(*args, **kwargs):
+            self._profile.count(PEBBLE_CALLS)
+            return attribute(*args, **kwargs)
+
+        return _counted_call
+
+
+class ReconcileProfile:
+    """Time spent in each phase of a reconcile, in seconds, and counts of
+       the work done during it
+    """
+
+    def __init__(self, event_name=None):
+        self.event_name = event_name
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {
+            TEMPLATES_RENDERED: 0,
+            FILES_PUSHED: 0,
+            BYTES_PUSHED: 0,
+            PEBBLE_CALLS: 0,
+        }
+        self.outcome = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block; the time of phases entered more than once
+           in the same reconcile is summed up
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def track_pebble_calls(self, container):
+        return _PebbleCallsCounter(container, self)
+
+    def to_dict(self):
+        return {
+            "event": self.event_name,
+            "started": self.started,
+            "outcome": self.outcome,
+            "phases": {name: round(elapsed, 6) for name, elapsed in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+
+def append_profile(profiles, profile, limit=RECONCILE_PROFILES_LIMIT):
+    """Append `profile` to the `profiles` list, dropping the oldest ones
+       beyond `limit`
+    """
+
+    profiles.append(profile)
+
+    while len(profiles) > limit:
+        del profiles[0]
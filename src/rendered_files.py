@@ -0,0 +1,278 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import hashlib
+import io
+import logging
+import posixpath
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ops.pebble import APIError
+
+logger = logging.getLogger(__name__)
+
+DIGEST_ALGORITHM = "sha256"
+
+DEFAULT_PUSH_CONCURRENCY = 4
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class _ChunksReader(io.RawIOBase):
+    """Readable stream over an iterable of `bytes` chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.bytes_read += size
+
+        return size
+
+
+class StreamedContent:
+    """Content of a file that is produced in chunks, e.g., by Jinja's
+       `Template.generate`, so that it never needs to be held in memory in
+       full: its digest is calculated incrementally, and the chunks are
+       produced again when the file is pushed.
+
+       `chunks_factory` is a callable returning a new iterable of `str` chunks
+       every time it is invoked.
+    """
+
+    def __init__(self, chunks_factory):
+        self._chunks_factory = chunks_factory
+        self._digest = None
+
+    def chunks(self):
+        for chunk in self._chunks_factory():
+            yield chunk.encode("utf-8")
+
+    def digest(self):
+        if self._digest is None:
+            hasher = hashlib.new(DIGEST_ALGORITHM)
+            for chunk in self.chunks():
+                hasher.update(chunk)
+
+            self._digest = f"{DIGEST_ALGORITHM}:{hasher.hexdigest()}"
+
+        return self._digest
+
+    def open(self):
+        return io.BufferedReader(_ChunksReader(self.chunks()), buffer_size=_CHUNK_SIZE)
+
+
+def content_digest(content):
+    """Calculate the digest of the content of a rendered file; unlike `hash()`,
+       the digest is stable across processes, so it can be compared to the one
+       persisted in the StoredState by previous hooks.
+    """
+
+    if isinstance(content, StreamedContent):
+        return content.digest()
+
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    return f"{DIGEST_ALGORITHM}:{hashlib.new(DIGEST_ALGORITHM, content).hexdigest()}"
+
+
+def container_file_digest(container, path):
+    """Calculate the digest of a file in the container, or return `None` if the
+       file cannot be found
+    """
+
+    try:
+        remote_file = container.pull(path, encoding=None)
+    except APIError as e:
+        if "No such file or directory" not in str(e):
+            logger.debug("Cannot pull file '%s' from the application container: %s",
+                         path, e)
+
+        return None
+
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    try:
+        while True:
+            chunk = remote_file.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+
+            hasher.update(chunk)
+    finally:
+        remote_file.close()
+
+    return f"{DIGEST_ALGORITHM}:{hasher.hexdigest()}"
+
+
+class FileSyncReport:
+    """Tracks what happened to each rendered file during a hook"""
+
+    def __init__(self):
+        self.skipped = []
+        self.pushed = []
+        self.failed = []
+        self.pushed_bytes = 0
+
+    def __str__(self):
+        return (f"{len(self.skipped)} skipped, {len(self.pushed)} pushed "
+                f"({self.pushed_bytes} bytes), {len(self.failed)} failed")
+
+
+def _parent_directories(paths):
+    return sorted({posixpath.dirname(path) for path in paths} - {"", "/"})
+
+
+def sync_rendered_files(container, rendered_files, stored_digests, verify=False,
+                        concurrency=DEFAULT_PUSH_CONCURRENCY):
+    """Push to the container, as one batch, the rendered files whose digest
+       differs from the one stored for the same path.
+
+       `rendered_files` is a list of `(path, content)` tuples, where `content`
+       is either a string or a `StreamedContent`, and `stored_digests` is
+       the mapping of path to digest persisted in the StoredState. When `verify`
+       is true, the digests of the files already in the container are checked
+       too, so that files lost (e.g., after the pod has been rescheduled) or
+       modified out of band are pushed again.
+
+       The parent directories of the files are created once per batch, and the
+       files are pushed concurrently by at most `concurrency` threads. The stored
+       digests are updated only if the whole batch is pushed successfully, so that
+       a failed batch is pushed again in its entirety by the next hook.
+    """
+
+    report = FileSyncReport()
+
+    contents = dict(rendered_files)
+    digests = {path: content_digest(content) for path, content in rendered_files}
+
+    candidates = [path for path in contents if stored_digests.get(path) != digests[path]]
+    unchanged = [path for path in contents if stored_digests.get(path) == digests[path]]
+
+    if not candidates and not verify:
+        report.skipped.extend(unchanged)
+        return report
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        if verify and unchanged:
+            container_digests = executor.map(
+                lambda path: container_file_digest(container, path), unchanged)
+
+            for path, container_digest in zip(unchanged, container_digests):
+                if container_digest == digests[path]:
+                    report.skipped.append(path)
+                else:
+                    logger.debug("File '%s' in the application container does not "
+                                 "match its stored digest", path)
+                    candidates.append(path)
+        else:
+            report.skipped.extend(unchanged)
+
+        if not candidates:
+            return report
+
+        failed_directories = set()
+        for directory in _parent_directories(candidates):
+            try:
+                container.make_dir(directory, make_parents=True)
+            except Exception:
+                logger.exception("Cannot create directory '%s' in the application "
+                                 "container", directory)
+                failed_directories.add(directory)
+
+        def _push(path):
+            """Push the file, and return how many bytes have been pushed, or
+               `None` if the push failed
+            """
+
+            if posixpath.dirname(path) in failed_directories:
+                return None
+
+            content = contents[path]
+            if isinstance(content, StreamedContent):
+                content = content.open()
+
+            try:
+                container.push(path, content)
+            except Exception:
+                logger.exception("Cannot push file '%s' to the application container", path)
+                return None
+
+            if isinstance(content, str):
+                return len(content.encode("utf-8"))
+
+            if isinstance(content, bytes):
+                return len(content)
+
+            return content.raw.bytes_read
+
+        for path, pushed_bytes in zip(candidates, executor.map(_push, candidates)):
+            if pushed_bytes is not None:
+                report.pushed.append(path)
+                report.pushed_bytes += pushed_bytes
+            else:
+                report.failed.append(path)
+
+    if not report.failed:
+        for path in report.pushed:
+            stored_digests[path] = digests[path]
+
+    return report
+
+
+class FileRemovalReport:
+    """Tracks which of the files no longer declared have been removed"""
+
+    def __init__(self):
+        self.removed = []
+        self.failed = []
+
+    def __str__(self):
+        return f"{len(self.removed)} removed, {len(self.failed)} failed"
+
+
+def remove_stale_files(container, stored_digests, declared_paths):
+    """Remove from the container the files in `stored_digests` whose path is
+       not among `declared_paths`, and prune their digests; the digests of the
+       files that cannot be removed are kept, so that their removal is retried
+       by the next hook
+    """
+
+    report = FileRemovalReport()
+
+    for path in sorted(set(stored_digests) - set(declared_paths)):
+        try:
+            container.remove_path(path)
+        except APIError as e:
+            if "No such file or directory" not in str(e):
+                logger.exception("Cannot remove file '%s' from the application "
+                                 "container", path)
+                report.failed.append(path)
+                continue
+        except Exception:
+            logger.exception("Cannot remove file '%s' from the application container", path)
+            report.failed.append(path)
+            continue
+
+        del stored_digests[path]
+        report.removed.append(path)
+
+    return report
@@ -0,0 +1,52 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import json
+import math
+
+# Peer relation the units coordinate their restarts over
+RESTART_RELATION = "restart"
+
+# Key of the unit data bags: when the unit requested to restart, as a
+# timestamp, until it is healthy again after the restart
+RESTART_REQUESTED_KEY = "restart-requested"
+# Key of the application data bag, set by the leader: JSON list of the units
+# allowed to restart
+RESTART_GRANTED_KEY = "restart-granted"
+
+
+def _requested_at(timestamp):
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return math.inf
+
+
+def grant_restart_locks(requests, granted, max_concurrent):
+    """Grant the restart lock to the units that requested it first, so that
+       at most `max_concurrent` units hold it at once, or all of them if it is
+       `0`; `requests` maps unit names to the timestamp of their request, and
+       `granted` lists the units currently holding the lock, which keep it
+       until they withdraw their request. Returns the units holding the lock.
+    """
+
+    holders = [unit for unit in granted if unit in requests]
+
+    queue = sorted((unit for unit in requests if unit not in holders),
+                   key=lambda unit: (_requested_at(requests[unit]), unit))
+    for unit in queue:
+        if max_concurrent and len(holders) >= max_concurrent:
+            break
+
+        holders.append(unit)
+
+    return holders
+
+
+def read_granted(app_data):
+    try:
+        granted = json.loads(app_data.get(RESTART_GRANTED_KEY) or "[]")
+    except ValueError:
+        return []
+
+    return granted if isinstance(granted, list) else []
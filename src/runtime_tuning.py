@@ -0,0 +1,135 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import math
+
+from cnb_metadata import MEMORY_CALCULATOR_HELPER
+
+_MIB = 1024 * 1024
+_GIB = 1024 * _MIB
+
+JAVA_TOOL_OPTIONS = "JAVA_TOOL_OPTIONS"
+NODE_OPTIONS = "NODE_OPTIONS"
+UV_THREADPOOL_SIZE = "UV_THREADPOOL_SIZE"
+NODE_CLUSTER_WORKERS = "NODE_CLUSTER_WORKERS"
+
+# Default of the Paketo memory calculator, suited to servlet containers
+# with large thread pools
+DEFAULT_JVM_THREAD_COUNT = 250
+MINIMUM_JVM_THREAD_COUNT = 50
+
+# Bounds of the libuv thread pool, which runs the file system, DNS and crypto
+# operations of Node.js
+DEFAULT_UV_THREADPOOL_SIZE = 4
+MAXIMUM_UV_THREADPOOL_SIZE = 1024
+
+MINIMUM_NODE_OLD_SPACE_SIZE = 32
+
+
+def _is_small_container(limits):
+    """Containers with less than 2 GiB of memory or 2 cores are better served
+       by the serial garbage collector, see the "server-class machine" JVM
+       ergonomics
+    """
+
+    return (limits.memory is not None and limits.memory < 2 * _GIB) or \
+        (limits.cpus is not None and limits.cpus < 2)
+
+
+def jvm_tuning_environment(limits, helpers):
+    """Environment variables sizing the JVM to the container limits.
+
+       When the image ships the Paketo memory calculator, which calculates the
+       heap size when the application starts, the calculator is given the
+       amount of threads to reserve stack memory for, scaled on the memory of
+       the container, and the headroom to leave for the memory outside of the
+       JVM; otherwise, the heap is sized as a percentage of the memory limit.
+    """
+
+    environment = {}
+    java_tool_options = []
+
+    if limits.cpus is not None:
+        # The JVM counts the cores of the node, not those of the container quota
+        java_tool_options.append(f"-XX:ActiveProcessorCount={max(1, math.ceil(limits.cpus))}")
+
+    if limits.memory is not None or limits.cpus is not None:
+        java_tool_options.append("-XX:+UseSerialGC" if _is_small_container(limits)
+                                 else "-XX:+UseG1GC")
+
+    if limits.memory is not None:
+        if MEMORY_CALCULATOR_HELPER in helpers:
+            # Thread stacks of 1 MiB take up at most an eighth of the memory
+            thread_count = min(DEFAULT_JVM_THREAD_COUNT,
+                               max(MINIMUM_JVM_THREAD_COUNT, limits.memory // _MIB // 8))
+
+            environment["BPL_JVM_THREAD_COUNT"] = str(thread_count)
+            environment["BPL_JVM_HEAD_ROOM"] = "5" if limits.memory >= 4 * _GIB else "10"
+        else:
+            java_tool_options.append("-XX:MaxRAMPercentage=75.0")
+
+    if java_tool_options:
+        environment[JAVA_TOOL_OPTIONS] = " ".join(java_tool_options)
+
+    return environment
+
+
+def cluster_workers(limits):
+    """Amount of workers of a Node.js cluster, one per whole core of the CPU
+       limit of the container; `None` if the container has no CPU limit
+    """
+
+    if limits.cpus is None:
+        return None
+
+    return max(1, math.floor(limits.cpus))
+
+
+def nodejs_tuning_environment(limits, workers=1):
+    """Environment variables sizing Node.js to the container limits, split
+       among the `workers` processes of a cluster: the old space of the V8
+       heap gets three quarters of the memory, and the libuv thread pool grows
+       with the cores beyond its default size
+    """
+
+    environment = {}
+
+    if limits.memory is not None:
+        old_space_size = max(MINIMUM_NODE_OLD_SPACE_SIZE,
+                             limits.memory * 3 // 4 // workers // _MIB)
+        environment[NODE_OPTIONS] = f"--max-old-space-size={old_space_size}"
+
+    if limits.cpus is not None:
+        environment[UV_THREADPOOL_SIZE] = str(min(
+            MAXIMUM_UV_THREADPOOL_SIZE,
+            max(DEFAULT_UV_THREADPOOL_SIZE, math.ceil(limits.cpus / workers))))
+
+    return environment
+
+
+def append_java_tool_options(environment, options):
+    """Append `options` to the `JAVA_TOOL_OPTIONS` of the environment"""
+
+    environment = dict(environment)
+
+    java_tool_options = environment.get(JAVA_TOOL_OPTIONS)
+    environment[JAVA_TOOL_OPTIONS] = f"{java_tool_options} {options}" \
+        if java_tool_options else options
+
+    return environment
+
+
+def apply_overrides(environment, overrides):
+    """Apply the per-key overrides of the tuning environment declared in the
+       manifest; keys overridden with `None` are removed
+    """
+
+    environment = dict(environment)
+
+    for key, value in (overrides or {}).items():
+        if value is None:
+            environment.pop(key, None)
+        else:
+            environment[key] = str(value)
+
+    return environment
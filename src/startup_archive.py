@@ -0,0 +1,104 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import hashlib
+import json
+import logging
+import posixpath
+import re
+
+from ops.pebble import APIError
+
+logger = logging.getLogger(__name__)
+
+# Directory of the application container the class data sharing archives are
+# stored in; it survives restarts of the application, but not of the pod
+STARTUP_ARCHIVE_DIRECTORY = "/var/lib/cnb-operator/startup-archives"
+
+STARTUP_ARCHIVE_EXTENSION = ".jsa"
+
+# Dynamic archives, dumped when the JVM exits, are supported since JDK 13
+MINIMUM_JVM_MAJOR_VERSION = 13
+
+_JVM_VERSION = re.compile(r"^(\d+)(?:\.(\d+))?")
+
+
+def jvm_major_version(version):
+    """Major version of a JVM version string like `11.0.11` or, before Java 9,
+       `1.8.0_292`; `None` if the version cannot be parsed
+    """
+
+    match = _JVM_VERSION.match(version or "")
+    if not match:
+        return None
+
+    major = int(match.group(1))
+    if major == 1 and match.group(2) is not None:
+        return int(match.group(2))
+
+    return major
+
+
+def startup_archive_path(cnb_metadata, directory=STARTUP_ARCHIVE_DIRECTORY):
+    """Path of the archive of the application described by `cnb_metadata`,
+       named after the digest of the image and of its metadata, so that the
+       archives of previous images are never used
+    """
+
+    serialized_metadata = json.dumps({
+        "image": cnb_metadata.get("image"),
+        "processes": cnb_metadata.get("processes"),
+        "helpers": cnb_metadata.get("helpers"),
+        "jvm_version": cnb_metadata.get("jvm_version"),
+    }, sort_keys=True)
+    digest = hashlib.sha256(serialized_metadata.encode("utf-8")).hexdigest()
+
+    return posixpath.join(directory, f"{digest[:32]}{STARTUP_ARCHIVE_EXTENSION}")
+
+
+def startup_archive_options(archive_path, archive_exists):
+    """JVM options that use the archive if it exists, or dump it when the JVM
+       exits, with the classes loaded by the application up to then
+    """
+
+    if archive_exists:
+        return f"-XX:SharedArchiveFile={archive_path}"
+
+    return f"-XX:ArchiveClassesAtExit={archive_path}"
+
+
+def startup_archive_exists(container, archive_path):
+    try:
+        return bool(container.list_files(archive_path, itself=True))
+    except APIError as e:
+        if "No such file or directory" not in str(e):
+            logger.debug("Cannot look up the startup archive '%s': %s", archive_path, e)
+
+        return False
+
+
+def remove_stale_startup_archives(container, archive_path):
+    """Remove the archives, in the directory of `archive_path`, of previous
+       images; returns their paths
+    """
+
+    directory = posixpath.dirname(archive_path)
+
+    try:
+        archives = container.list_files(directory, pattern=f"*{STARTUP_ARCHIVE_EXTENSION}")
+    except APIError as e:
+        logger.debug("Cannot list the startup archives in '%s': %s", directory, e)
+        return []
+
+    removed = []
+    for archive in archives:
+        if archive.path == archive_path:
+            continue
+
+        try:
+            container.remove_path(archive.path)
+            removed.append(archive.path)
+        except APIError:
+            logger.exception("Cannot remove the stale startup archive '%s'", archive.path)
+
+    return removed
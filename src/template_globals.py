@@ -0,0 +1,321 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import hashlib
+import json
+
+from collections.abc import Mapping, MutableSequence
+from fnmatch import fnmatchcase
+
+from templates import create_template_environment
+
+_GLOB_CHARACTERS = set("*?[")
+
+# Marks the branches of the template globals not matched by a selector
+_NOT_SELECTED = object()
+
+
+class LazyDataBag(Mapping):
+    """Read-only view over the data bag of a remote application or unit, which
+       is fetched from Juju the first time one of its fields is accessed
+    """
+
+    def __init__(self, relation, entity):
+        self._relation = relation
+        self._entity = entity
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = dict(self._relation.data[self._entity]) \
+                if self._entity is not None else {}
+
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        # Templates printing a data bag render it like a dictionary
+        return repr(self._load())
+
+
+def _unit_order(unit):
+    """Order units by application and unit number, e.g., `mongodb/2` before
+       `mongodb/10`
+    """
+
+    name = getattr(unit, "name", unit)
+    application, _, number = name.rpartition("/")
+
+    return application, int(number) if number.isdigit() else -1, name
+
+
+class _FieldIndex:
+    """Index of the fields of the data bags of the remote units of a relation,
+       built with one pass over the units the first time it is accessed
+    """
+
+    def __init__(self, units):
+        self._units = units
+        self._values = None
+        self._first_units = None
+
+    def _build(self):
+        if self._values is None:
+            self._values = {}
+            self._first_units = {}
+
+            for unit in self._units:
+                for field, value in unit.items():
+                    self._values.setdefault(field, []).append(value)
+                    self._first_units.setdefault(field, unit)
+
+    def values_of(self):
+        self._build()
+        return self._values
+
+    def first_units(self):
+        self._build()
+        return self._first_units
+
+
+class _IndexView(Mapping):
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getitem__(self, field):
+        return self._loader()[field]
+
+    def __iter__(self):
+        return iter(self._loader())
+
+    def __len__(self):
+        return len(self._loader())
+
+
+# Functions of the aggregates declared in the manifest
+AGGREGATE_JOIN = "join"
+AGGREGATE_LIST = "list"
+AGGREGATE_FIRST = "first"
+AGGREGATE_COUNT = "count"
+
+
+def _aggregate(definition, relation_data, template_environment):
+    units = relation_data["units"]
+
+    if "template" in definition:
+        unit_template = template_environment.from_string(definition["template"])
+        values = [unit_template.render(unit=unit, app=relation_data["app"]) for unit in units]
+    elif "field" in definition:
+        values = relation_data["fields"].get(definition["field"], [])
+    else:
+        values = units
+
+    function = definition.get("function", AGGREGATE_JOIN)
+    if function == AGGREGATE_JOIN:
+        return definition.get("separator", ",").join(str(value) for value in values)
+    if function == AGGREGATE_FIRST:
+        return values[0] if values else None
+    if function == AGGREGATE_COUNT:
+        return len(values)
+
+    return list(values)
+
+
+class _Aggregates(Mapping):
+    """Aggregates declared in the manifest for a relation, each calculated
+       the first time a template accesses it
+    """
+
+    def __init__(self, definitions, relation_data):
+        self._definitions = {definition["name"]: definition for definition in definitions}
+        self._relation_data = relation_data
+        self._template_environment = create_template_environment()
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            self._values[name] = _aggregate(self._definitions[name], self._relation_data,
+                                            self._template_environment)
+
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(self._definitions)
+
+    def __len__(self):
+        return len(self._definitions)
+
+
+class LazyRelationData(Mapping):
+    """Data of a consumed relation, exposed to the templates as
+       `relations.consumes.<name>`: the `app` data bag and the `units` data
+       bags are fetched only when templates access them, and memoized for
+       the rest of the hook.
+
+       Values derived from the data of all the units are calculated once per
+       hook and shared by all the templates:
+
+       * `fields.<field>`: the values of the field, one per unit that has it
+       * `first.<field>`: the data bag of the first unit that has the field
+       * `aggregates.<name>`: the aggregates declared in the manifest
+
+       Derived values are not iterated over, e.g., by `materialize`, as they
+       duplicate the data of the units.
+    """
+
+    _KEYS = ("app", "units")
+    _DERIVED_KEYS = ("fields", "first", "aggregates")
+
+    def __init__(self, relations, local_unit, aggregates=None):
+        self._relations = relations
+        self._local_unit = local_unit
+        self._aggregate_definitions = aggregates or []
+        self._data = {}
+
+    def __getitem__(self, key):
+        if key not in self._KEYS and key not in self._DERIVED_KEYS:
+            raise KeyError(key)
+
+        if key not in self._data:
+            if key == "app":
+                first_relation = self._relations[0]
+                self._data[key] = LazyDataBag(first_relation, first_relation.app)
+            elif key == "units":
+                # Juju does not guarantee the order of the units; sorting them
+                # keeps rendered templates and pages of units stable
+                self._data[key] = [LazyDataBag(relation, unit)
+                                   for relation in self._relations
+                                   for unit in sorted(relation.units, key=_unit_order)
+                                   if unit is not self._local_unit]
+            elif key == "aggregates":
+                self._data[key] = _Aggregates(self._aggregate_definitions, self)
+            else:
+                if "index" not in self._data:
+                    self._data["index"] = _FieldIndex(self["units"])
+
+                index = self._data["index"]
+                self._data[key] = _IndexView(index.values_of if key == "fields"
+                                             else index.first_units)
+
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def materialize(value):
+    """Recursively convert lazy mappings into dictionaries, fetching all the
+       data bags they are backed by, and the mappings and lists of the
+       StoredState into plain ones
+    """
+
+    if isinstance(value, Mapping):
+        return {key: materialize(item) for key, item in value.items()}
+
+    if isinstance(value, (list, MutableSequence)):
+        return [materialize(item) for item in value]
+
+    return value
+
+
+def relation_data_digest(relation_data):
+    serialized_data = json.dumps(materialize(relation_data), sort_keys=True)
+
+    return hashlib.sha256(serialized_data.encode("utf-8")).hexdigest()
+
+
+def _page(key, value, offset, limit):
+    """Paginate the `units` lists; the data bags of the units outside the
+       page are never fetched
+    """
+
+    if key != "units":
+        return list(enumerate(value))
+
+    end = offset + limit if limit else None
+
+    return list(enumerate(value))[offset:end]
+
+
+def _summarize(value, key, offset, limit, keys_only):
+    if isinstance(value, Mapping):
+        if keys_only:
+            return sorted(value)
+
+        return {item_key: _summarize(item, item_key, offset, limit, keys_only)
+                for item_key, item in value.items()}
+
+    if isinstance(value, list):
+        return [_summarize(item, None, offset, limit, keys_only)
+                for _, item in _page(key, value, offset, limit)]
+
+    return value
+
+
+def _select(value, segments, key, offset, limit, keys_only):
+    if not segments:
+        return _summarize(value, key, offset, limit, keys_only)
+
+    segment, other_segments = segments[0], segments[1:]
+    is_glob = bool(_GLOB_CHARACTERS & set(segment))
+
+    if isinstance(value, Mapping):
+        if is_glob:
+            keys = [item_key for item_key in value if fnmatchcase(str(item_key), segment)]
+        else:
+            keys = [segment] if segment in value else []
+
+        selection = {}
+        for item_key in keys:
+            item = _select(value[item_key], other_segments, item_key, offset, limit, keys_only)
+            if item is not _NOT_SELECTED:
+                selection[item_key] = item
+
+        return selection if selection else _NOT_SELECTED
+
+    if isinstance(value, list):
+        selection = []
+        for index, item in _page(key, value, offset, limit):
+            if fnmatchcase(str(index), segment):
+                item = _select(item, other_segments, None, offset, limit, keys_only)
+                if item is not _NOT_SELECTED:
+                    selection.append(item)
+
+        return selection
+
+    return _NOT_SELECTED
+
+
+def select(template_globals, selector=None, offset=0, limit=None, keys_only=False):
+    """Materialize the part of the template globals matched by `selector`,
+       fetching only the data bags in it.
+
+       `selector` is a dotted path, like `relations.consumes.database.app`,
+       whose segments may be glob patterns, like `relations.consumes.*.units`;
+       segments matching items of lists are matched against their indexes.
+       The `units` lists are paginated by `offset` and `limit`, and with
+       `keys_only` mappings are replaced by the sorted list of their keys.
+
+       Returns `None` if the selector matches nothing.
+    """
+
+    segments = selector.split(".") if selector else []
+
+    selection = _select(template_globals, segments, None, offset, limit, keys_only)
+
+    return None if selection is _NOT_SELECTED else selection
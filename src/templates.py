@@ -0,0 +1,370 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+#
+# This module is imported by both the charm and `appcraft`, which uses it
+# to precompile the templates at pack time: keep it free of `ops` imports.
+
+import hashlib
+import json
+import logging
+import signal
+import threading
+import time
+
+import jinja2
+
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager
+from jinja2 import ChoiceLoader, DictLoader, Environment, ModuleLoader, nodes
+
+from os import path
+
+logger = logging.getLogger(__name__)
+
+COMPILED_TEMPLATES_DIRECTORY = "compiled_templates"
+
+# Nodes that render other templates, whose relation dependencies are unknown
+_TEMPLATE_REFERENCE_NODES = (nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport)
+
+
+def _json_default(value):
+    """Serialize the mappings and sequences that `json.dumps` does not know,
+       like the lazy data bags of the template globals
+    """
+
+    if isinstance(value, Mapping):
+        return dict(value)
+
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        return list(value)
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def create_template_environment(**options):
+    """Jinja environment to render templates with the template globals, whose
+       lazy mappings the `tojson` filter can serialize
+    """
+
+    environment = Environment(**options)
+    environment.policies["json.dumps_kwargs"] = dict(
+        environment.policies["json.dumps_kwargs"], default=_json_default)
+
+    return environment
+
+
+def environment_template_name(env_name):
+    return f"environment/{env_name}"
+
+
+def file_template_name(file_path):
+    return f"files/{file_path}"
+
+
+def template_sources(config):
+    """Map the name of each template declared in the charm config to its source"""
+
+    sources = {}
+
+    for environment_variable in config.get("environment") or []:
+        name = environment_template_name(environment_variable["name"])
+        sources[name] = environment_variable["template"]
+
+    for file in config.get("files") or []:
+        sources[file_template_name(file["path"])] = file["template"]
+
+    return sources
+
+
+def _accessor_name(node):
+    if isinstance(node, nodes.Getattr):
+        return node.attr
+
+    if isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+        return node.arg.value
+
+    return None
+
+
+def _collect_relation_dependencies(node, dependencies):
+    """Add to `dependencies` the names of the relations read by `node` and its
+       children; return `False` if `node` reads the relations in ways that
+       cannot be analyzed, e.g., `relations.consumes[name]`, by calling methods
+       of `relations.consumes` like `items()` or `get(name)`, or by passing
+       `relations` around as a whole
+    """
+
+    accessors = []
+    current = node
+    while isinstance(current, (nodes.Getattr, nodes.Getitem)):
+        accessors.insert(0, current)
+        current = current.node
+
+    if isinstance(current, nodes.Name) and current.name == "relations":
+        if len(accessors) < 2 or _accessor_name(accessors[0]) != "consumes":
+            return False
+
+        relation_name = _accessor_name(accessors[1])
+        if not isinstance(relation_name, str):
+            return False
+
+        # `relations.consumes` is a dictionary, whose methods would otherwise
+        # be mistaken for relation names
+        if isinstance(accessors[1], nodes.Getattr) and hasattr(dict, relation_name):
+            return False
+
+        dependencies.add(relation_name)
+
+        # Subscripts like `units[index]` may read relations too
+        return all(_collect_relation_dependencies(accessor.arg, dependencies)
+                   for accessor in accessors if isinstance(accessor, nodes.Getitem))
+
+    return all(_collect_relation_dependencies(child, dependencies)
+               for child in node.iter_child_nodes())
+
+
+def relation_dependencies(template_environment, source):
+    """Return the sorted names of the consumed relations whose data is read by the
+       template, or `None` if the template may read the data of any relation,
+       including templates that include or import other templates
+    """
+
+    template_ast = template_environment.parse(source)
+    if template_ast.find(_TEMPLATE_REFERENCE_NODES) is not None:
+        return None
+
+    dependencies = set()
+    if not _collect_relation_dependencies(template_ast, dependencies):
+        return None
+
+    return sorted(dependencies)
+
+
+def compile_templates(config, target_directory):
+    """Compile all the templates declared in the charm config into Python
+       modules in `target_directory`, and return the metadata to be stored
+       under the `compiled_templates` key of the charm config.
+
+       Raises `jinja2.TemplateSyntaxError` on the first malformed template.
+    """
+
+    sources = template_sources(config)
+
+    template_environment = Environment(loader=DictLoader(sources))
+    template_environment.compile_templates(target_directory, zip=None,
+                                           ignore_errors=False)
+
+    return {
+        "directory": path.basename(target_directory),
+        "jinja2_version": jinja2.__version__,
+        "dependencies": {
+            name: relation_dependencies(template_environment, source)
+            for name, source in sources.items()
+        }
+    }
+
+
+class RenderBudgetExceededException(Exception):
+
+    def __init__(self, name, message):
+        super().__init__(self)
+
+        self.name = name
+        self.message = message
+
+
+class _RenderDeadlineExceeded(Exception):
+    pass
+
+
+def _raise_render_deadline_exceeded(signum, frame):
+    raise _RenderDeadlineExceeded()
+
+
+@contextmanager
+def _render_deadline(seconds):
+    """Interrupt the enclosed block once `seconds` have elapsed, by raising
+       `_RenderDeadlineExceeded` from a SIGALRM handler. Signal handlers can
+       be installed only in the main thread, which runs the hooks: elsewhere,
+       e.g., in the threads pushing files, the block is not interrupted.
+    """
+
+    if not seconds or not hasattr(signal, "setitimer") or \
+            threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_render_deadline_exceeded)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+class RenderBudget:
+    """Limits on rendering templates: how long, in seconds, rendering each
+       template may take, how many bytes each rendered template may be, and
+       how many bytes the whole rendered environment may be. Limits that
+       are `None` or `0` are not enforced.
+
+       Templates are rendered in chunks, and the output size is checked after
+       each chunk. In the main thread, rendering is interrupted by a timer as
+       soon as it exceeds the render time, so that a runaway template, e.g.,
+       one with a loop over a large relation that outputs nothing, is stopped;
+       in other threads, the render time is checked after each chunk. Only the
+       time spent rendering the chunks counts towards the render time, not the
+       one the consumer spends on them, e.g., pushing them to the application
+       container.
+    """
+
+    def __init__(self, max_render_time=None, max_output_size=None, max_environment_size=None):
+        self.max_render_time = max_render_time
+        self.max_output_size = max_output_size
+        self.max_environment_size = max_environment_size
+
+    def generate(self, name, template, template_globals):
+        """Render the template in chunks within the budget; raises
+           `RenderBudgetExceededException` once a limit is exceeded
+        """
+
+        render_time = 0.0
+        output_size = 0
+
+        chunks = template.generate(template_globals)
+        while True:
+            remaining_time = self.max_render_time - render_time \
+                if self.max_render_time else None
+
+            start = time.perf_counter()
+            try:
+                with _render_deadline(remaining_time):
+                    chunk = next(chunks, None)
+            except _RenderDeadlineExceeded:
+                raise self._render_time_exceeded(name)
+            finally:
+                render_time += time.perf_counter() - start
+
+            if chunk is None:
+                return
+
+            output_size += len(chunk.encode("utf-8"))
+
+            if self.max_output_size and output_size > self.max_output_size:
+                raise RenderBudgetExceededException(
+                    name, f"Template '{name}' exceeds the maximum output size "
+                    f"of {self.max_output_size} bytes")
+
+            if self.max_render_time and render_time > self.max_render_time:
+                raise self._render_time_exceeded(name)
+
+            yield chunk
+
+    def _render_time_exceeded(self, name):
+        return RenderBudgetExceededException(
+            name, f"Template '{name}' exceeds the maximum render time "
+            f"of {self.max_render_time} seconds")
+
+    def render(self, name, template, template_globals):
+        return "".join(self.generate(name, template, template_globals))
+
+    def check_environment(self, environment):
+        """Check the size of the environment, counted like in the environment
+           block of a process, i.e., as `NAME=value` strings terminated by NUL
+        """
+
+        if not self.max_environment_size or not environment:
+            return
+
+        sizes = {name: len(f"{name}={value}".encode("utf-8")) + 1
+                 for name, value in environment.items()}
+
+        if sum(sizes.values()) > self.max_environment_size:
+            largest = environment_template_name(max(sizes, key=sizes.get))
+
+            raise RenderBudgetExceededException(
+                largest, f"Environment exceeds the maximum size of "
+                f"{self.max_environment_size} bytes, the largest value is "
+                f"rendered by template '{largest}'")
+
+
+class CharmTemplates:
+    """Look up the templates of environment variables and files, preferring
+       the modules precompiled by `appcraft` at pack time over compiling
+       the template sources in the charm config.
+
+       When `relation_names` is specified, templates depending on relations
+       not among them are considered to possibly read any relation.
+    """
+
+    def __init__(self, config, charm_directory, relation_names=None):
+        self._sources = template_sources(config)
+        self._dependencies = {}
+        self._relation_names = None if relation_names is None else set(relation_names)
+
+        loaders = []
+
+        compiled_templates = config.get("compiled_templates")
+        if compiled_templates:
+            self._dependencies.update(compiled_templates.get("dependencies") or {})
+
+            compiled_directory = path.join(charm_directory,
+                                           compiled_templates["directory"])
+
+            if compiled_templates.get("jinja2_version") != jinja2.__version__:
+                logger.warning("Templates were compiled with Jinja %s, but Jinja %s "
+                               "is installed; compiling the templates at runtime",
+                               compiled_templates.get("jinja2_version"),
+                               jinja2.__version__)
+            elif not path.isdir(compiled_directory):
+                logger.warning("Directory of compiled templates '%s' not found; "
+                               "compiling the templates at runtime", compiled_directory)
+            else:
+                loaders.append(ModuleLoader(compiled_directory))
+
+        # Templates that are not found among the compiled ones are
+        # compiled from the sources
+        loaders.append(DictLoader(self._sources))
+
+        self.environment = create_template_environment(loader=ChoiceLoader(loaders))
+
+    @property
+    def sources_digest(self):
+        """Digest of the sources of all templates, which changes when the charm
+           is upgraded with a different manifest
+        """
+
+        serialized_sources = json.dumps(self._sources, sort_keys=True)
+
+        return hashlib.sha256(serialized_sources.encode("utf-8")).hexdigest()
+
+    def relation_dependencies(self, name):
+        """Return the names of the relations read by the template, or `None`
+           if it may read any relation; dependencies not precomputed by
+           `appcraft` are calculated on first access
+        """
+
+        if name not in self._dependencies:
+            self._dependencies[name] = relation_dependencies(self.environment,
+                                                             self._sources[name])
+
+        dependencies = self._dependencies[name]
+        if dependencies is not None and self._relation_names is not None and \
+                not self._relation_names.issuperset(dependencies):
+            return None
+
+        return dependencies
+
+    def is_affected_by(self, name, relation_names):
+        dependencies = self.relation_dependencies(name)
+        if dependencies is None:
+            return True
+
+        return any(relation_name in dependencies for relation_name in relation_names)
+
+    def environment_template(self, env_name):
+        return self.environment.get_template(environment_template_name(env_name))
+
+    def file_template(self, file_path):
+        return self.environment.get_template(file_template_name(file_path))
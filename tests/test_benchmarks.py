@@ -0,0 +1,55 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+
+from benchmarks.hooks import Scenario, compare_with_baseline, run_benchmarks
+
+
+def _report(median):
+    return {
+        "results": [{
+            "scenario": "small",
+            "measurements": {
+                "calculate_template_globals": {"median": median}
+            }
+        }]
+    }
+
+
+class BenchmarksTests(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        report = run_benchmarks([Scenario("tiny", relations=2, units=3, templates=4)],
+                                repeat=1)
+
+        result = report["results"][0]
+        self.assertEqual(result["scenario"], "tiny")
+        self.assertEqual(set(result["measurements"]), {
+            "determine_application_type",
+            "calculate_template_globals",
+            "ensure_application_updated_and_running",
+            "ensure_application_updated_and_running_unchanged",
+        })
+        self.assertEqual(result["counters"]["templates-rendered"], 4)
+        self.assertEqual(result["counters"]["files-pushed"], 2)
+
+    def test_compare_with_baseline(self):
+        comparison = compare_with_baseline(_report(0.02), _report(0.01))
+        self.assertTrue(comparison[0]["regressed"])
+        self.assertEqual(comparison[0]["ratio"], 2)
+
+        # Slower, but within the tolerance
+        comparison = compare_with_baseline(_report(0.011), _report(0.01))
+        self.assertFalse(comparison[0]["regressed"])
+
+        # Slower, but by less than the noise threshold
+        comparison = compare_with_baseline(_report(0.0002), _report(0.0001))
+        self.assertFalse(comparison[0]["regressed"])
+
+        # Scenarios missing from the baseline are not compared
+        self.assertEqual(compare_with_baseline(_report(0.02), {"results": []}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
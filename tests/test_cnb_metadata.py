@@ -0,0 +1,79 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import io
+import unittest
+
+from cnb_metadata import ApplicationType, detect_application_type, process_argv, \
+    read_metadata, read_processes
+
+
+def _read_fixture_processes(fixture_name):
+    with open(f"tests/fixtures/cnb-metadata/{fixture_name}") as metadata_file:
+        return read_processes(metadata_file)
+
+
+class CnbMetadataTests(unittest.TestCase):
+
+    def test_read_processes(self):
+        self.assertEqual(_read_fixture_processes("java_jar.toml"), [
+            {
+                "type": process_type,
+                "command": "java",
+                "args": ["com.canonical.java.test.UselessApplication"],
+                "direct": True
+            } for process_type in ["executable-jar", "task", "web"]
+        ])
+
+    def test_read_helpers_and_jvm_version(self):
+        with open("tests/fixtures/cnb-metadata/spring_boot.toml") as metadata_file:
+            metadata = read_metadata(metadata_file)
+
+        self.assertIn("memory-calculator", metadata["helpers"])
+        self.assertEqual(metadata["jvm_version"], "11.0.11")
+
+        with open("tests/fixtures/cnb-metadata/nodejs_http_server.toml") as metadata_file:
+            metadata = read_metadata(metadata_file)
+
+        self.assertEqual(metadata["helpers"], ["ca-certificates-helper"])
+        self.assertIsNone(metadata["jvm_version"])
+
+    def test_other_tables_are_not_parsed(self):
+        metadata_file = io.StringIO("""
+[[bom]]
+  name = "not valid TOML" = "because it is not parsed"
+
+[[processes]]
+  type = "web"
+  command = "node src/index.js"
+  direct = false
+
+[[slices]]
+  also = = "not parsed"
+""")
+
+        self.assertEqual(read_processes(metadata_file), [{
+            "type": "web",
+            "command": "node src/index.js",
+            "args": [],
+            "direct": False
+        }])
+
+    def test_process_argv(self):
+        self.assertEqual(process_argv({"command": "node src/index.js", "args": ["--port", "80"],
+                                       "direct": False}),
+                         ["node", "src/index.js", "--port", "80"])
+        self.assertEqual(process_argv({"command": "java", "args": ["-jar", "app.jar"],
+                                       "direct": True}),
+                         ["java", "-jar", "app.jar"])
+        self.assertIsNone(process_argv({"command": "cd app && node $SCRIPT", "args": [],
+                                        "direct": False}))
+
+    def test_detect_application_type(self):
+        self.assertEqual(detect_application_type(_read_fixture_processes("spring_boot.toml")),
+                         ApplicationType.SPRING_BOOT)
+        self.assertEqual(detect_application_type(_read_fixture_processes("java_jar.toml")),
+                         ApplicationType.JVM)
+        self.assertEqual(
+            detect_application_type(_read_fixture_processes("nodejs_http_server.toml")),
+            ApplicationType.NODE_JS)
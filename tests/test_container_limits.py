@@ -0,0 +1,66 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import io
+import unittest
+from unittest.mock import Mock
+
+from container_limits import ContainerLimits, parse_cpu_limit, parse_memory_limit, \
+    read_container_limits
+from ops.pebble import APIError
+
+
+def _container_with_files(files):
+    container = Mock()
+
+    def _pull(path, *args, **kwargs):
+        if path not in files:
+            raise APIError({}, 404, "Not Found", "No such file or directory")
+        return io.StringIO(files[path])
+
+    container.pull.side_effect = _pull
+
+    return container
+
+
+class ContainerLimitsTests(unittest.TestCase):
+
+    def test_parse_memory_limit(self):
+        self.assertEqual(parse_memory_limit("536870912"), 536870912)
+        self.assertIsNone(parse_memory_limit("max"))
+        self.assertIsNone(parse_memory_limit("9223372036854771712"))
+        self.assertIsNone(parse_memory_limit(None))
+
+    def test_parse_cpu_limit(self):
+        self.assertEqual(parse_cpu_limit("150000", "100000"), 1.5)
+        self.assertIsNone(parse_cpu_limit("max", "100000"))
+        self.assertIsNone(parse_cpu_limit("-1", "100000"))
+        self.assertIsNone(parse_cpu_limit(None, None))
+
+    def test_read_cgroup_v2_limits(self):
+        container = _container_with_files({
+            "/sys/fs/cgroup/memory.max": "1073741824\n",
+            "/sys/fs/cgroup/cpu.max": "200000 100000\n",
+        })
+
+        self.assertEqual(read_container_limits(container),
+                         ContainerLimits(memory=1073741824, cpus=2))
+
+    def test_read_cgroup_v1_limits(self):
+        container = _container_with_files({
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes": "9223372036854771712\n",
+            "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000\n",
+            "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n",
+        })
+
+        self.assertEqual(read_container_limits(container), ContainerLimits(cpus=0.5))
+
+    def test_unreadable_limits(self):
+        self.assertEqual(read_container_limits(_container_with_files({})), ContainerLimits())
+        self.assertEqual(read_container_limits(_container_with_files({
+            "/sys/fs/cgroup/memory.max": "not a number"
+        })), ContainerLimits())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import socket
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from health import check_http_health, check_tcp_health, wait_until_healthy
+
+
+class _ActuatorHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/actuator/health":
+            self.send_response(200)
+            body = b'{"status":"UP"}'
+        else:
+            self.send_response(503)
+            body = b'{"status":"DOWN"}'
+
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HealthCheckTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), _ActuatorHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def test_healthy(self):
+        self.assertIsNone(check_http_health(f"{self.base_url}/actuator/health", 5))
+
+    def test_unhealthy(self):
+        self.assertEqual(check_http_health(f"{self.base_url}/down", 5), "status code 503")
+
+    def test_unreachable(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertIsNotNone(check_http_health(f"{self.base_url}/actuator/health", 5))
+
+
+class TcpHealthCheckTests(unittest.TestCase):
+
+    def test_healthy(self):
+        with socket.socket() as listening_socket:
+            listening_socket.bind(("127.0.0.1", 0))
+            listening_socket.listen()
+
+            port = listening_socket.getsockname()[1]
+
+            self.assertIsNone(check_tcp_health("127.0.0.1", port, 5))
+
+    def test_unreachable(self):
+        with socket.socket() as closed_socket:
+            closed_socket.bind(("127.0.0.1", 0))
+            port = closed_socket.getsockname()[1]
+
+        self.assertTrue(check_tcp_health("127.0.0.1", port, 5).startswith(f"port {port}: "))
+
+
+class WaitUntilHealthyTests(unittest.TestCase):
+
+    def test_healthy_after_failures(self):
+        failures = ["status code 503", "status code 503"]
+
+        def check():
+            return failures.pop() if failures else None
+
+        self.assertIsNone(wait_until_healthy(check, 5, interval=0.01))
+        self.assertEqual(failures, [])
+
+    def test_timeout(self):
+        checks = []
+
+        def check():
+            checks.append(None)
+            return f"status code 503 ({len(checks)})"
+
+        failure = wait_until_healthy(check, 0.05, interval=0.01)
+
+        self.assertGreater(len(checks), 1)
+        self.assertEqual(failure, f"status code 503 ({len(checks)})")
+
+    def test_no_timeout_checks_once(self):
+        checks = []
+
+        def check():
+            checks.append(None)
+            return "status code 503"
+
+        self.assertEqual(wait_until_healthy(check, 0), "status code 503")
+        self.assertEqual(len(checks), 1)
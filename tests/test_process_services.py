@@ -0,0 +1,52 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+
+from process_services import SERVICE_EXIT_POLICIES, parse_process_replicas, \
+    plan_process_services
+
+
+class ProcessServicesTests(unittest.TestCase):
+
+    def test_parse_process_replicas(self):
+        self.assertEqual(parse_process_replicas(""), {})
+        self.assertEqual(parse_process_replicas(None), {})
+        self.assertEqual(parse_process_replicas("worker=2, scheduler = 1,"),
+                         {"worker": 2, "scheduler": 1})
+
+        with self.assertRaises(ValueError):
+            parse_process_replicas("worker")
+
+        with self.assertRaises(ValueError):
+            parse_process_replicas("worker=-1")
+
+    def test_plan_process_services(self):
+        services = plan_process_services(["web", "worker", "task"], {"worker": 2})
+
+        self.assertEqual(list(services), ["worker-0", "worker-1"])
+        self.assertEqual(services["worker-1"].to_layer_service({"A": "1"}), {
+            "override": "replace",
+            "summary": "Runs the 'worker' process of the Cloud Native Buildpack lifecycle",
+            "command": "/cnb/process/worker",
+            "environment": {"A": "1", "PROCESS_TYPE": "worker", "PROCESS_INDEX": "1"},
+            "startup": "enabled",
+        })
+
+        self.assertEqual(services["worker-1"].to_layer_service(
+            {}, SERVICE_EXIT_POLICIES)["on-failure"], "ignore")
+
+    def test_previous_services_are_disabled(self):
+        services = plan_process_services(["web", "worker", "task"], {"task": 1},
+                                         [("worker", 0), ("worker", 1)])
+
+        self.assertEqual([(name, service.enabled) for name, service in services.items()], [
+            ("task-0", True),
+            ("worker-0", False),
+            ("worker-1", False),
+        ])
+        self.assertEqual(services["worker-0"].to_layer_service({})["startup"], "disabled")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+
+from unittest.mock import Mock
+
+from profiling import PEBBLE_CALLS, ReconcileProfile, append_profile
+
+
+class ReconcileProfileTests(unittest.TestCase):
+
+    def test_phases_are_summed_up(self):
+        profile = ReconcileProfile("config_changed")
+
+        with profile.phase("render"):
+            pass
+        first_elapsed = profile.phases["render"]
+
+        with profile.phase("render"):
+            pass
+
+        self.assertGreaterEqual(profile.phases["render"], first_elapsed)
+        self.assertEqual(list(profile.to_dict()["phases"]), ["render"])
+
+    def test_phase_is_timed_on_exceptions(self):
+        profile = ReconcileProfile()
+
+        with self.assertRaises(ValueError):
+            with profile.phase("push"):
+                raise ValueError()
+
+        self.assertIn("push", profile.phases)
+
+    def test_pebble_calls_are_counted(self):
+        profile = ReconcileProfile()
+        container = Mock()
+        container.name = "application"
+
+        tracked_container = profile.track_pebble_calls(container)
+        tracked_container.get_services("application")
+        tracked_container.start("application")
+
+        self.assertEqual(tracked_container.name, "application")
+        self.assertEqual(profile.counters[PEBBLE_CALLS], 2)
+        container.start.assert_called_once_with("application")
+
+    def test_append_profile_drops_oldest_profiles(self):
+        profiles = []
+        for index in range(5):
+            append_profile(profiles, {"index": index}, limit=3)
+
+        self.assertEqual([profile["index"] for profile in profiles], [2, 3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
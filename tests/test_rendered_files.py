@@ -0,0 +1,154 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import hashlib
+import io
+import unittest
+from unittest.mock import Mock
+
+from ops.pebble import APIError
+from rendered_files import StreamedContent, content_digest, remove_stale_files, \
+    sync_rendered_files
+
+
+def _container_with_files(files):
+    container = Mock()
+
+    def _pull(path, *args, **kwargs):
+        if path not in files:
+            raise APIError({}, 404, "Not Found", "No such file or directory")
+        return io.BytesIO(files[path].encode("utf-8"))
+
+    container.pull.side_effect = _pull
+
+    return container
+
+
+class RenderedFilesTests(unittest.TestCase):
+
+    def test_content_digest_is_stable(self):
+        self.assertEqual(content_digest("foo=bar\n"), content_digest(b"foo=bar\n"))
+        self.assertEqual(content_digest("foo=bar\n"),
+                         "sha256:" + hashlib.sha256(b"foo=bar\n").hexdigest())
+        self.assertNotEqual(content_digest("foo=bar\n"), content_digest("foo=baz\n"))
+
+    def test_unchanged_files_are_not_pushed(self):
+        container = _container_with_files({})
+        stored_digests = {}
+
+        report = sync_rendered_files(container, [("/a", "a"), ("/b", "b")], stored_digests)
+
+        self.assertEqual(report.pushed, ["/a", "/b"])
+        self.assertEqual(container.push.call_count, 2)
+
+        report = sync_rendered_files(container, [("/a", "a"), ("/b", "B")], stored_digests)
+
+        self.assertEqual(report.skipped, ["/a"])
+        self.assertEqual(report.pushed, ["/b"])
+        self.assertEqual(container.push.call_count, 3)
+        self.assertFalse(container.pull.called)
+
+    def test_verify_pushes_files_missing_or_modified_in_container(self):
+        stored_digests = {
+            "/a": content_digest("a"),
+            "/b": content_digest("b"),
+            "/c": content_digest("c"),
+        }
+        container = _container_with_files({"/a": "a", "/b": "modified"})
+
+        report = sync_rendered_files(container, [("/a", "a"), ("/b", "b"), ("/c", "c")],
+                                     stored_digests, verify=True)
+
+        self.assertEqual(report.skipped, ["/a"])
+        self.assertEqual(report.pushed, ["/b", "/c"])
+
+    def test_failed_push_does_not_update_digest(self):
+        container = _container_with_files({})
+        container.push.side_effect = Exception("Pebble is gone")
+        stored_digests = {}
+
+        report = sync_rendered_files(container, [("/a", "a")], stored_digests)
+
+        self.assertEqual(report.failed, ["/a"])
+        self.assertEqual(stored_digests, {})
+        self.assertEqual(str(report), "0 skipped, 0 pushed (0 bytes), 1 failed")
+
+    def test_files_are_pushed_as_one_batch(self):
+        container = _container_with_files({})
+        stored_digests = {}
+
+        report = sync_rendered_files(container, [
+            ("/config/a.properties", "a"),
+            ("/config/b.properties", "b"),
+            ("/config/certs/ca.pem", "ca"),
+        ], stored_digests, concurrency=2)
+
+        self.assertEqual(report.pushed, [
+            "/config/a.properties", "/config/b.properties", "/config/certs/ca.pem"
+        ])
+        self.assertEqual([call.args[0] for call in container.make_dir.call_args_list],
+                         ["/config", "/config/certs"])
+        self.assertEqual(len(stored_digests), 3)
+
+    def test_failed_batch_does_not_update_digests(self):
+        def _push(path, content):
+            if path == "/b":
+                raise Exception("Pebble is gone")
+
+        container = _container_with_files({})
+        container.push.side_effect = _push
+        stored_digests = {"/a": content_digest("old a")}
+
+        report = sync_rendered_files(container, [("/a", "a"), ("/b", "b")], stored_digests)
+
+        self.assertEqual(report.pushed, ["/a"])
+        self.assertEqual(report.failed, ["/b"])
+        self.assertEqual(stored_digests, {"/a": content_digest("old a")})
+
+    def test_streamed_content(self):
+        def _chunks():
+            for index in range(10000):
+                yield f"host-{index}.example.com\n"
+
+        content = StreamedContent(_chunks)
+        expected = "".join(_chunks())
+
+        self.assertEqual(content.digest(), content_digest(expected))
+        self.assertEqual(content.open().read(), expected.encode("utf-8"))
+
+        with content.open() as stream:
+            self.assertEqual(stream.read(5), b"host-")
+            self.assertEqual(stream.read(), expected.encode("utf-8")[5:])
+
+    def test_streamed_content_is_pushed_as_stream(self):
+        container = _container_with_files({})
+        pushed = {}
+        container.push.side_effect = lambda path, source: pushed.update({path: source.read()})
+
+        report = sync_rendered_files(container, [("/a", StreamedContent(lambda: ["a", "b"]))],
+                                     {})
+
+        self.assertEqual(report.pushed, ["/a"])
+        self.assertEqual(pushed, {"/a": b"ab"})
+
+    def test_undeclared_files_are_removed(self):
+        container = Mock()
+
+        def _remove_path(path, *args, **kwargs):
+            if path == "/missing":
+                raise APIError({}, 404, "Not Found", "No such file or directory")
+            if path == "/failing":
+                raise APIError({}, 500, "Internal Server Error", "permission denied")
+
+        container.remove_path.side_effect = _remove_path
+
+        stored_digests = {"/declared": "sha256:1", "/stale": "sha256:2",
+                          "/missing": "sha256:3", "/failing": "sha256:4"}
+
+        report = remove_stale_files(container, stored_digests, ["/declared"])
+
+        self.assertEqual(report.removed, ["/missing", "/stale"])
+        self.assertEqual(report.failed, ["/failing"])
+        self.assertEqual(str(report), "2 removed, 1 failed")
+        # Removal of the failed file is retried by the next hook
+        self.assertEqual(stored_digests, {"/declared": "sha256:1", "/failing": "sha256:4"})
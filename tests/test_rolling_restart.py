@@ -0,0 +1,38 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+
+from rolling_restart import grant_restart_locks, read_granted
+
+
+class RollingRestartTests(unittest.TestCase):
+
+    def test_locks_are_granted_in_request_order(self):
+        requests = {"app/0": "30.0", "app/1": "10.0", "app/2": "20.0"}
+
+        self.assertEqual(grant_restart_locks(requests, [], 1), ["app/1"])
+        self.assertEqual(grant_restart_locks(requests, [], 2), ["app/1", "app/2"])
+        self.assertEqual(grant_restart_locks(requests, [], 0), ["app/1", "app/2", "app/0"])
+
+    def test_holders_keep_the_lock_until_they_withdraw_their_request(self):
+        requests = {"app/0": "10.0", "app/1": "20.0"}
+
+        self.assertEqual(grant_restart_locks(requests, ["app/1"], 1), ["app/1"])
+        self.assertEqual(grant_restart_locks({"app/0": "10.0"}, ["app/1"], 1), ["app/0"])
+        self.assertEqual(grant_restart_locks({}, ["app/1"], 1), [])
+
+    def test_malformed_requests_are_granted_last(self):
+        requests = {"app/0": "not a timestamp", "app/1": "20.0"}
+
+        self.assertEqual(grant_restart_locks(requests, [], 1), ["app/1"])
+
+    def test_read_granted(self):
+        self.assertEqual(read_granted({"restart-granted": '["app/0"]'}), ["app/0"])
+        self.assertEqual(read_granted({}), [])
+        self.assertEqual(read_granted({"restart-granted": "{"}), [])
+        self.assertEqual(read_granted({"restart-granted": '{"app/0": 1}'}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+
+from container_limits import ContainerLimits
+from runtime_tuning import append_java_tool_options, apply_overrides, cluster_workers, \
+    jvm_tuning_environment, nodejs_tuning_environment
+
+_GIB = 1024 * 1024 * 1024
+
+
+class JvmTuningTests(unittest.TestCase):
+
+    def test_small_container_with_memory_calculator(self):
+        self.assertEqual(jvm_tuning_environment(ContainerLimits(memory=_GIB // 2, cpus=0.5),
+                                                ["memory-calculator"]), {
+            "BPL_JVM_THREAD_COUNT": "64",
+            "BPL_JVM_HEAD_ROOM": "10",
+            "JAVA_TOOL_OPTIONS": "-XX:ActiveProcessorCount=1 -XX:+UseSerialGC",
+        })
+
+    def test_large_container_with_memory_calculator(self):
+        self.assertEqual(jvm_tuning_environment(ContainerLimits(memory=8 * _GIB, cpus=4),
+                                                ["memory-calculator"]), {
+            "BPL_JVM_THREAD_COUNT": "250",
+            "BPL_JVM_HEAD_ROOM": "5",
+            "JAVA_TOOL_OPTIONS": "-XX:ActiveProcessorCount=4 -XX:+UseG1GC",
+        })
+
+    def test_without_memory_calculator(self):
+        self.assertEqual(jvm_tuning_environment(ContainerLimits(memory=4 * _GIB), []), {
+            "JAVA_TOOL_OPTIONS": "-XX:+UseG1GC -XX:MaxRAMPercentage=75.0",
+        })
+
+    def test_without_limits(self):
+        self.assertEqual(jvm_tuning_environment(ContainerLimits(), ["memory-calculator"]), {})
+
+    def test_nodejs_tuning(self):
+        self.assertEqual(nodejs_tuning_environment(ContainerLimits(memory=2 * _GIB, cpus=8)), {
+            "NODE_OPTIONS": "--max-old-space-size=1536",
+            "UV_THREADPOOL_SIZE": "8",
+        })
+        self.assertEqual(nodejs_tuning_environment(ContainerLimits(memory=2 * _GIB, cpus=8),
+                                                   workers=8), {
+            "NODE_OPTIONS": "--max-old-space-size=192",
+            "UV_THREADPOOL_SIZE": "4",
+        })
+        self.assertEqual(nodejs_tuning_environment(ContainerLimits()), {})
+
+    def test_cluster_workers(self):
+        self.assertEqual(cluster_workers(ContainerLimits(cpus=2.5)), 2)
+        self.assertEqual(cluster_workers(ContainerLimits(cpus=0.5)), 1)
+        self.assertIsNone(cluster_workers(ContainerLimits(memory=_GIB)))
+
+    def test_append_java_tool_options(self):
+        self.assertEqual(append_java_tool_options({}, "-Xshare:auto"),
+                         {"JAVA_TOOL_OPTIONS": "-Xshare:auto"})
+        self.assertEqual(append_java_tool_options({"JAVA_TOOL_OPTIONS": "-XX:+UseG1GC"},
+                                                  "-Xshare:auto"),
+                         {"JAVA_TOOL_OPTIONS": "-XX:+UseG1GC -Xshare:auto"})
+
+    def test_apply_overrides(self):
+        self.assertEqual(apply_overrides({"A": "1", "B": "2"}, {"A": "3", "B": None, "C": 4}),
+                         {"A": "3", "C": "4"})
+        self.assertEqual(apply_overrides({"A": "1"}, None), {"A": "1"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import Mock
+
+from ops.pebble import APIError
+from startup_archive import jvm_major_version, remove_stale_startup_archives, \
+    startup_archive_exists, startup_archive_options, startup_archive_path
+
+CNB_METADATA = {
+    "image": "1234",
+    "application_type": "SPRING_BOOT",
+    "processes": [{"type": "web", "command": "java", "args": [], "direct": True}],
+    "helpers": ["memory-calculator"],
+    "jvm_version": "17.0.1",
+}
+
+
+class StartupArchiveTests(unittest.TestCase):
+
+    def test_jvm_major_version(self):
+        self.assertEqual(jvm_major_version("17.0.1"), 17)
+        self.assertEqual(jvm_major_version("11"), 11)
+        self.assertEqual(jvm_major_version("1.8.0_292"), 8)
+        self.assertIsNone(jvm_major_version("unknown"))
+        self.assertIsNone(jvm_major_version(None))
+
+    def test_archive_path_changes_with_image_and_metadata(self):
+        archive_path = startup_archive_path(CNB_METADATA, directory="/archives")
+
+        self.assertRegex(archive_path, r"^/archives/[0-9a-f]{32}\.jsa$")
+        self.assertEqual(startup_archive_path(dict(CNB_METADATA), directory="/archives"),
+                         archive_path)
+        self.assertNotEqual(startup_archive_path(dict(CNB_METADATA, image="5678"),
+                                                 directory="/archives"), archive_path)
+        self.assertNotEqual(startup_archive_path(dict(CNB_METADATA, jvm_version="17.0.2"),
+                                                 directory="/archives"), archive_path)
+
+    def test_archive_options(self):
+        self.assertEqual(startup_archive_options("/archives/a.jsa", False),
+                         "-XX:ArchiveClassesAtExit=/archives/a.jsa")
+        self.assertEqual(startup_archive_options("/archives/a.jsa", True),
+                         "-XX:SharedArchiveFile=/archives/a.jsa")
+
+    def test_archive_exists(self):
+        container = Mock()
+        container.list_files.return_value = [Mock(path="/archives/a.jsa")]
+
+        self.assertTrue(startup_archive_exists(container, "/archives/a.jsa"))
+        container.list_files.assert_called_once_with("/archives/a.jsa", itself=True)
+
+        container.list_files.side_effect = APIError({}, 404, "Not Found",
+                                                    "No such file or directory")
+
+        self.assertFalse(startup_archive_exists(container, "/archives/a.jsa"))
+
+    def test_stale_archives_are_removed(self):
+        container = Mock()
+        container.list_files.return_value = [Mock(path="/archives/a.jsa"),
+                                             Mock(path="/archives/b.jsa"),
+                                             Mock(path="/archives/c.jsa")]
+        container.remove_path.side_effect = [None, APIError({}, 500, "Error", "Error")]
+
+        self.assertEqual(remove_stale_startup_archives(container, "/archives/a.jsa"),
+                         ["/archives/b.jsa"])
+        container.list_files.assert_called_once_with("/archives", pattern="*.jsa")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,249 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+from unittest.mock import Mock
+
+from jinja2 import Environment
+from template_globals import LazyRelationData, materialize, relation_data_digest, select
+from templates import create_template_environment
+
+
+class _RecordingDataBags(dict):
+    """Relation data bags that record which entities have been fetched"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetched = []
+
+    def __getitem__(self, entity):
+        self.fetched.append(entity)
+        return super().__getitem__(entity)
+
+
+def _relation(app_data, units_data):
+    relation = Mock()
+    relation.app = "app"
+    relation.units = [f"unit/{index}" for index in range(len(units_data))]
+    relation.data = _RecordingDataBags({"app": app_data})
+    relation.data.update({f"unit/{index}": data for index, data in enumerate(units_data)})
+
+    return relation
+
+
+class LazyRelationDataTests(unittest.TestCase):
+
+    def test_data_bags_fetched_on_access(self):
+        relation = _relation({"uri": "mongo://test_uri:12345/"},
+                             [{"host": f"10.0.0.{index}"} for index in range(100)])
+        relation_data = LazyRelationData([relation], local_unit="local/0")
+
+        template_globals = {"relations": {"consumes": {"database": relation_data}}}
+
+        rendered = Environment().from_string(
+            "{{ relations.consumes.database.units | length }} "
+            "{{ relations.consumes.database.units[1].host }}",
+            template_globals).render()
+
+        self.assertEqual(rendered, "100 10.0.0.1")
+        self.assertEqual(relation.data.fetched, ["unit/1"])
+
+        Environment().from_string("{{ relations.consumes.database.units[1].host }}",
+                                  template_globals).render()
+
+        self.assertEqual(relation.data.fetched, ["unit/1"])
+
+    def test_units_are_sorted(self):
+        relation = _relation({}, [{"host": f"10.0.0.{index}"} for index in range(12)])
+        relation.units = list(reversed(relation.units))
+        relation_data = LazyRelationData([relation], local_unit="local/0")
+
+        self.assertEqual([unit["host"] for unit in relation_data["units"]],
+                         [f"10.0.0.{index}" for index in range(12)])
+
+    def test_data_bags_render_like_dictionaries(self):
+        relation = _relation({"uri": "mongo://test_uri:12345/"}, [{"host": "10.0.0.1"}])
+        relation_data = LazyRelationData([relation], local_unit="local/0")
+
+        template_globals = {"relations": {"consumes": {"database": relation_data}}}
+
+        def _render(source):
+            return create_template_environment().from_string(
+                source, template_globals).render()
+
+        self.assertEqual(_render("{{ relations.consumes.database.units[0] }}"),
+                         str({"host": "10.0.0.1"}))
+        self.assertEqual(_render("{{ relations.consumes.database.app }}"),
+                         str({"uri": "mongo://test_uri:12345/"}))
+        self.assertEqual(_render("{{ relations.consumes.database.units }}"),
+                         str([{"host": "10.0.0.1"}]))
+
+    def test_data_bags_to_json(self):
+        relation = _relation({"uri": "mongo://test_uri:12345/"}, [{"host": "10.0.0.1"}])
+        relation_data = LazyRelationData([relation], local_unit="local/0")
+
+        template_globals = {"relations": {"consumes": {"database": relation_data}}}
+
+        rendered = create_template_environment().from_string(
+            "{{ relations.consumes.database.units | tojson }}|"
+            "{{ relations.consumes.database | tojson }}", template_globals).render()
+
+        units, database = rendered.split("|")
+        self.assertEqual(json.loads(units), [{"host": "10.0.0.1"}])
+        self.assertEqual(json.loads(database), {
+            "app": {"uri": "mongo://test_uri:12345/"},
+            "units": [{"host": "10.0.0.1"}]
+        })
+
+    def test_materialize(self):
+        relation = _relation({"uri": "mongo://test_uri:12345/"}, [{"host": "10.0.0.1"}])
+        relation_data = LazyRelationData([relation], local_unit="local/0")
+
+        self.assertEqual(materialize({"database": relation_data}), {
+            "database": {
+                "app": {"uri": "mongo://test_uri:12345/"},
+                "units": [{"host": "10.0.0.1"}]
+            }
+        })
+
+    def test_relation_data_digest(self):
+        def _digest(units_data):
+            relation = _relation({"uri": "mongo://test_uri:12345/"}, units_data)
+            return relation_data_digest(LazyRelationData([relation], local_unit="local/0"))
+
+        self.assertEqual(_digest([{"host": "10.0.0.1"}]), _digest([{"host": "10.0.0.1"}]))
+        self.assertNotEqual(_digest([{"host": "10.0.0.1"}]), _digest([{"host": "10.0.0.2"}]))
+
+
+class SelectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.database = _relation({"uri": "mongo://test_uri:12345/"},
+                                  [{"host": f"10.0.0.{index}", "port": "27017"}
+                                   for index in range(200)])
+        self.tracing = _relation({"endpoint": "jaeger:14268"}, [])
+
+        self.template_globals = {
+            "relations": {
+                "consumes": {
+                    "database": LazyRelationData([self.database], local_unit="local/0"),
+                    "tracing": LazyRelationData([self.tracing], local_unit="local/0"),
+                }
+            }
+        }
+
+    def test_select_everything(self):
+        self.assertEqual(select(self.template_globals), materialize(self.template_globals))
+
+    def test_select_fetches_only_selected_data_bags(self):
+        selection = select(self.template_globals, "relations.consumes.database.units.3.host")
+
+        self.assertEqual(selection, {
+            "relations": {"consumes": {"database": {"units": [{"host": "10.0.0.3"}]}}}
+        })
+        self.assertEqual(self.database.data.fetched, ["unit/3"])
+        self.assertEqual(self.tracing.data.fetched, [])
+
+    def test_select_with_globs(self):
+        selection = select(self.template_globals, "relations.consumes.*.app")
+
+        self.assertEqual(selection["relations"]["consumes"], {
+            "database": {"app": {"uri": "mongo://test_uri:12345/"}},
+            "tracing": {"app": {"endpoint": "jaeger:14268"}},
+        })
+
+        selection = select(self.template_globals, "relations.consumes.t*.app.endpoint")
+
+        self.assertEqual(selection["relations"]["consumes"], {
+            "tracing": {"app": {"endpoint": "jaeger:14268"}}
+        })
+
+    def test_select_paginates_units(self):
+        selection = select(self.template_globals, "relations.consumes.database.units.*.host",
+                           offset=10, limit=2)
+
+        self.assertEqual(selection["relations"]["consumes"]["database"]["units"],
+                         [{"host": "10.0.0.10"}, {"host": "10.0.0.11"}])
+        self.assertEqual(self.database.data.fetched, ["unit/10", "unit/11"])
+
+        selection = select(self.template_globals, "relations.consumes.database",
+                           offset=199, limit=10)
+
+        self.assertEqual(selection["relations"]["consumes"]["database"]["units"],
+                         [{"host": "10.0.0.199", "port": "27017"}])
+
+    def test_select_keys_only(self):
+        selection = select(self.template_globals, "relations.consumes.database.units",
+                           limit=2, keys_only=True)
+
+        self.assertEqual(selection["relations"]["consumes"]["database"]["units"],
+                         [["host", "port"], ["host", "port"]])
+
+        selection = select(self.template_globals, "relations.consumes", keys_only=True)
+
+        self.assertEqual(selection, {"relations": {"consumes": ["database", "tracing"]}})
+        self.assertEqual(self.database.data.fetched, ["unit/0", "unit/1"])
+
+    def test_select_matching_nothing(self):
+        self.assertIsNone(select(self.template_globals, "relations.consumes.missing"))
+        self.assertIsNone(select(self.template_globals, "relations.consumes.database.app.nope"))
+
+
+class DerivedRelationDataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.relation = _relation({"port": "27017"}, [
+            {"host": "10.0.0.1"},
+            {"host": "10.0.0.2", "primary": "true"},
+            {"host": "10.0.0.3"},
+        ])
+
+    def _render(self, source, aggregates=None):
+        relation_data = LazyRelationData([self.relation], local_unit="local/0",
+                                         aggregates=aggregates)
+        template_globals = {"relations": {"consumes": {"database": relation_data}}}
+
+        return Environment().from_string(source, template_globals).render()
+
+    def test_field_indexes(self):
+        self.assertEqual(self._render(
+            "{{ relations.consumes.database.fields.host | join(',') }} "
+            "{{ relations.consumes.database.first.primary.host }}"),
+            "10.0.0.1,10.0.0.2,10.0.0.3 10.0.0.2")
+
+    def test_aggregates(self):
+        aggregates = [
+            {"name": "hosts", "relation": "database",
+             "template": "{{ unit.host }}:{{ app.port }}"},
+            {"name": "primary", "relation": "database", "field": "primary",
+             "function": "first"},
+            {"name": "replicas", "relation": "database", "function": "count"},
+            {"name": "addresses", "relation": "database", "field": "host",
+             "function": "list"},
+            {"name": "joined", "relation": "database", "field": "host",
+             "separator": ";"},
+        ]
+
+        self.assertEqual(self._render(
+            "{% set aggregates = relations.consumes.database.aggregates %}"
+            "{{ aggregates.hosts }}|{{ aggregates.primary }}|{{ aggregates.replicas }}|"
+            "{{ aggregates.addresses | length }}|{{ aggregates.joined }}", aggregates),
+            "10.0.0.1:27017,10.0.0.2:27017,10.0.0.3:27017|true|3|3|"
+            "10.0.0.1;10.0.0.2;10.0.0.3")
+
+    def test_derived_values_are_calculated_once(self):
+        relation_data = LazyRelationData([self.relation], local_unit="local/0", aggregates=[
+            {"name": "hosts", "relation": "database", "field": "host"}
+        ])
+
+        self.assertIs(relation_data["fields"]["host"], relation_data["fields"]["host"])
+        relation_data["aggregates"]["hosts"]
+        relation_data["first"]["host"]
+
+        self.assertEqual(sorted(self.relation.data.fetched), ["unit/0", "unit/1", "unit/2"])
+
+    def test_derived_values_are_not_materialized(self):
+        relation_data = LazyRelationData([self.relation], local_unit="local/0")
+
+        self.assertEqual(set(materialize(relation_data)), {"app", "units"})
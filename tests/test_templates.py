@@ -0,0 +1,240 @@
+# Copyright 2021 Ubuntu
+# See LICENSE file for licensing details.
+
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+from jinja2 import Environment, TemplateSyntaxError
+from templates import COMPILED_TEMPLATES_DIRECTORY, CharmTemplates, RenderBudget, \
+    RenderBudgetExceededException, compile_templates
+
+CONFIG = {
+    "environment": [
+        {"name": "URI", "template": "{{relations.consumes.database.app.uri}}"}
+    ],
+    "files": [
+        {"path": "/etc/app.properties", "template": "uri={{relations.consumes.database.app.uri}}"}
+    ]
+}
+
+TEMPLATE_GLOBALS = {
+    "relations": {
+        "consumes": {
+            "database": {
+                "app": {"uri": "mongo://test_uri:12345/"},
+                "units": []
+            }
+        }
+    }
+}
+
+
+class CharmTemplatesTests(unittest.TestCase):
+
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+
+        self.charm_directory = temporary_directory.name
+
+    def test_compiled_templates_are_used(self):
+        config = dict(CONFIG)
+        config["compiled_templates"] = compile_templates(
+            config, os.path.join(self.charm_directory, COMPILED_TEMPLATES_DIRECTORY))
+
+        templates = CharmTemplates(config, self.charm_directory)
+
+        template = templates.environment_template("URI")
+        self.assertTrue(template.filename.startswith(
+            os.path.join(self.charm_directory, COMPILED_TEMPLATES_DIRECTORY)))
+        self.assertEqual(template.render(TEMPLATE_GLOBALS), "mongo://test_uri:12345/")
+
+        self.assertEqual(templates.file_template("/etc/app.properties").render(TEMPLATE_GLOBALS),
+                         "uri=mongo://test_uri:12345/")
+
+    def test_templates_compiled_by_other_jinja_version_are_ignored(self):
+        config = dict(CONFIG)
+        config["compiled_templates"] = compile_templates(
+            config, os.path.join(self.charm_directory, COMPILED_TEMPLATES_DIRECTORY))
+        config["compiled_templates"]["jinja2_version"] = "0.0.1"
+
+        with self.assertLogs("templates", level="WARNING"):
+            template = CharmTemplates(config, self.charm_directory).environment_template("URI")
+
+        self.assertEqual(template.filename, "<template>")
+        self.assertEqual(template.render(TEMPLATE_GLOBALS), "mongo://test_uri:12345/")
+
+    def test_templates_without_compiled_modules(self):
+        template = CharmTemplates(CONFIG, self.charm_directory).environment_template("URI")
+
+        self.assertEqual(template.render(TEMPLATE_GLOBALS), "mongo://test_uri:12345/")
+
+    def test_malformed_template_fails_compilation(self):
+        config = {
+            "environment": [{"name": "BROKEN", "template": "{{ "}]
+        }
+
+        with self.assertRaises(TemplateSyntaxError) as context:
+            compile_templates(config, self.charm_directory)
+
+        self.assertEqual(context.exception.name, "environment/BROKEN")
+
+    def test_relation_dependencies(self):
+        config = {
+            "environment": [
+                {"name": "STATIC", "template": "static"},
+                {"name": "HOSTS", "template": (
+                    "{% for unit in relations.consumes['distributed-tracing'].units %}"
+                    "{{ unit['agent-address'] }}:{{ relations.consumes.database.app.port }}"
+                    "{% endfor %}")},
+                {"name": "DYNAMIC", "template": "{{ relations.consumes[name].app.uri }}"},
+                {"name": "WHOLE", "template": "{{ relations.consumes | tojson }}"},
+            ]
+        }
+
+        templates = CharmTemplates(config, self.charm_directory)
+
+        self.assertEqual(templates.relation_dependencies("environment/STATIC"), [])
+        self.assertEqual(templates.relation_dependencies("environment/HOSTS"),
+                         ["database", "distributed-tracing"])
+        self.assertIsNone(templates.relation_dependencies("environment/DYNAMIC"))
+        self.assertIsNone(templates.relation_dependencies("environment/WHOLE"))
+
+        self.assertFalse(templates.is_affected_by("environment/STATIC", ["database"]))
+        self.assertTrue(templates.is_affected_by("environment/HOSTS", ["database"]))
+        self.assertTrue(templates.is_affected_by("environment/WHOLE", ["database"]))
+
+    def test_relation_dependencies_of_unanalyzable_templates(self):
+        config = {
+            "environment": [
+                {"name": "URI", "template": "{{ relations.consumes.database.app.uri }}"},
+                {"name": "ITEMS", "template": (
+                    "{% for name, relation in relations.consumes.items() %}"
+                    "{{ name }}={{ relation.app.uri }}{% endfor %}")},
+                {"name": "VALUES", "template": (
+                    "{% for relation in relations.consumes.values() %}"
+                    "{{ relation.app.uri }}{% endfor %}")},
+                {"name": "GET", "template": (
+                    "{{ relations.consumes.get('database').app.uri }}")},
+                {"name": "INCLUDE", "template": "{% include 'environment/URI' %}"},
+                {"name": "IMPORT", "template": (
+                    "{% import 'environment/URI' as uri %}{{ uri }}")},
+                {"name": "FROM_IMPORT", "template": (
+                    "{% from 'environment/URI' import macro %}{{ macro() }}")},
+                {"name": "UNDECLARED", "template": "{{ relations.consumes.cache.app.uri }}"},
+            ]
+        }
+
+        templates = CharmTemplates(config, self.charm_directory,
+                                   relation_names=["database"])
+
+        self.assertEqual(templates.relation_dependencies("environment/URI"), ["database"])
+
+        for name in ("ITEMS", "VALUES", "GET", "INCLUDE", "IMPORT", "FROM_IMPORT",
+                     "UNDECLARED"):
+            self.assertIsNone(templates.relation_dependencies(f"environment/{name}"), name)
+            self.assertTrue(templates.is_affected_by(f"environment/{name}", ["other"]), name)
+
+    def test_relation_dependencies_are_precomputed(self):
+        config = dict(CONFIG)
+        config["compiled_templates"] = compile_templates(
+            config, os.path.join(self.charm_directory, COMPILED_TEMPLATES_DIRECTORY))
+
+        self.assertEqual(config["compiled_templates"]["dependencies"], {
+            "environment/URI": ["database"],
+            "files//etc/app.properties": ["database"]
+        })
+
+
+class _SlowUnits:
+    """Units that take a while to be iterated over"""
+
+    def __iter__(self):
+        for index in range(1000):
+            time.sleep(0.001)
+            yield {"host": f"10.0.0.{index}"}
+
+
+class RenderBudgetTests(unittest.TestCase):
+
+    def test_render_within_budget(self):
+        budget = RenderBudget(max_render_time=10, max_output_size=100, max_environment_size=100)
+        template = Environment().from_string("{{ greeting }}, world")
+
+        self.assertEqual(budget.render("environment/GREETING", template, {"greeting": "Hello"}),
+                         "Hello, world")
+        budget.check_environment({"GREETING": "Hello, world"})
+
+    def test_max_output_size(self):
+        budget = RenderBudget(max_output_size=1024)
+        template = Environment().from_string("{% for i in range(100000) %}{{ i }}{% endfor %}")
+
+        with self.assertRaises(RenderBudgetExceededException) as context:
+            budget.render("files//etc/app.properties", template, {})
+
+        self.assertEqual(context.exception.name, "files//etc/app.properties")
+        self.assertEqual(context.exception.message, "Template 'files//etc/app.properties' "
+                         "exceeds the maximum output size of 1024 bytes")
+
+    def test_max_render_time(self):
+        budget = RenderBudget(max_render_time=0.05)
+        template = Environment().from_string(
+            "{% for unit in units %}{{ unit.host }},{% endfor %}")
+
+        start = time.perf_counter()
+        with self.assertRaises(RenderBudgetExceededException) as context:
+            budget.render("environment/HOSTS", template, {"units": _SlowUnits()})
+
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(context.exception.message, "Template 'environment/HOSTS' exceeds "
+                         "the maximum render time of 0.05 seconds")
+
+    def test_max_render_time_interrupts_loops_without_output(self):
+        budget = RenderBudget(max_render_time=0.05)
+        template = Environment().from_string(
+            "{% set ns = namespace(hosts='') %}"
+            "{% for unit in units %}{% set ns.hosts = ns.hosts ~ unit.host %}{% endfor %}"
+            "{{ ns.hosts }}")
+
+        start = time.perf_counter()
+        with self.assertRaises(RenderBudgetExceededException) as context:
+            budget.render("environment/HOSTS", template, {"units": _SlowUnits()})
+
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(context.exception.message, "Template 'environment/HOSTS' exceeds "
+                         "the maximum render time of 0.05 seconds")
+
+        # The timer is disarmed
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def test_max_render_time_excludes_consumer_time(self):
+        budget = RenderBudget(max_render_time=0.2)
+        template = Environment().from_string("{% for i in range(20) %}{{ i }},{% endfor %}")
+
+        # A slow consumer, like a push of the file to the application container
+        chunks = []
+        for chunk in budget.generate("files//etc/app.properties", template, {}):
+            time.sleep(0.02)
+            chunks.append(chunk)
+
+        self.assertEqual("".join(chunks), ",".join(str(i) for i in range(20)) + ",")
+
+    def test_max_environment_size(self):
+        budget = RenderBudget(max_environment_size=16)
+
+        # `A=1234567890\0` is 13 bytes
+        budget.check_environment({"A": "1234567890"})
+
+        with self.assertRaises(RenderBudgetExceededException) as context:
+            budget.check_environment({"A": "1234567890", "B": "123"})
+
+        self.assertEqual(context.exception.name, "environment/A")
+
+    def test_disabled_budgets(self):
+        budget = RenderBudget(max_render_time=0, max_output_size=0, max_environment_size=0)
+        template = Environment().from_string("{% for i in range(10000) %}{{ i }}{% endfor %}")
+
+        budget.check_environment({"VALUE": budget.render("environment/VALUE", template, {})})